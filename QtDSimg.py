@@ -3,70 +3,82 @@
 # Robert Schauer 22-Apr-2023
 # With assistance from ChatGPT
 
-import requests
-import json
 import os
-import base64
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
 from PyQt5 import QtWidgets, QtGui, QtCore
 
+from generation_settings import ENGINE_IDS, STYLE_PRESETS, read_api_key
+from job_runner import JobRunner
+from providers import StabilityProvider, connect_daemon
+
+# Live preview: the pause in editing before a preview is requested, the
+# diffusion steps a preview gets (the full image uses the API default), and
+# how many recent previews are kept for prompts the user returns to
+PREVIEW_DELAY_MS = 700
+PREVIEW_STEPS = 10
+PREVIEW_CACHE_SIZE = 32
+
 class TextToImageApp(QtWidgets.QWidget):
     def __init__(self):
         super().__init__()
 
-        self.engine_ids = [
-            "stable-diffusion-v1",
-            "stable-diffusion-v1-5",
-            "stable-diffusion-512-v2-0",
-            "stable-diffusion-768-v2-0",
-            "stable-diffusion-512-v2-1",
-            "stable-diffusion-768-v2-1",
-            "stable-diffusion-xl-beta-v2-2-2",
-            "stable-inpainting-v1-0",
-            "stable-inpainting-512-v2-0"
-        ]
         self.api_host = os.getenv("API_HOST", "https://api.stability.ai")
 
-        # Read the API key from api_key.txt
-        with open("api_key.txt", "r") as f:
-            self.api_key = f.readline().strip()
+        # The API key, direct provider and catalog are loaded by the first
+        # request, so the window can open without touching the disk or the network stack
+        self.api_key = None
+        self.direct_provider = None
+        self.catalog = None
+        self.backend_lock = threading.Lock()
 
         # Create UI elements
         self.prompt_label = QtWidgets.QLabel("Enter the prompt:")
         self.prompt_input = QtWidgets.QLineEdit()
         self.style_preset_label = QtWidgets.QLabel("Select a style preset:")
         self.style_preset_dropdown = QtWidgets.QComboBox()
-        self.style_preset_dropdown.addItems([
-            "3d-model",
-            "analog-film",
-            "anime",
-            "cinematic",
-            "comic-book",
-            "digital-art",
-            "enhance",
-            "fantasy-art",
-            "isometric",
-            "line-art",
-            "low-poly",
-            "modeling-compound",
-            "neon-punk",
-            "origami",
-            "photographic",
-            "pixel-art",
-            "tile-texture"
-        ])
+        self.style_preset_dropdown.addItems(STYLE_PRESETS)
         self.engine_id_label = QtWidgets.QLabel("Select an engine ID:")
         self.engine_id_dropdown = QtWidgets.QComboBox()
-        self.engine_id_dropdown.addItems(self.engine_ids)
+        self.engine_id_dropdown.addItems(ENGINE_IDS)
         self.filename_label = QtWidgets.QLabel("Enter the filename:")
         self.filename_input = QtWidgets.QLineEdit("out.png")
+        self.preview_checkbox = QtWidgets.QCheckBox("Live preview while editing")
         self.generate_button = QtWidgets.QPushButton("Generate")
+        self.status_label = QtWidgets.QLabel()
         self.image_label = QtWidgets.QLabel()
         self.image_label.setAlignment(QtCore.Qt.AlignCenter)
         self.image_label.setMinimumHeight(500)
 
+        self.job_runner = JobRunner(parent=self)
+
         # Connect button to function that generates the image
         self.generate_button.clicked.connect(self.generate_image)
 
+        # With live preview on, a cheap few-step image of the current settings
+        # is generated once editing pauses; Generate then makes the full image
+        # from the preview's seed. An edit makes the preview in flight stale.
+        # Previews run one at a time on their own thread, so they never hold
+        # up Generate; edits made meanwhile only queue the latest settings.
+        self.preview_runner = JobRunner(max_threads=1, parent=self)
+        self.preview_timer = QtCore.QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(PREVIEW_DELAY_MS)
+        self.preview_timer.timeout.connect(self.start_preview)
+        self.preview_job = None
+        self.preview_queued = False
+        self.preview_dir = None
+        # (prompt, style preset, engine id) -> (path, seed), least recently shown first
+        self.previews = OrderedDict()
+        self.prompt_input.textChanged.connect(self.schedule_preview)
+        self.style_preset_dropdown.currentTextChanged.connect(self.schedule_preview)
+        self.engine_id_dropdown.currentTextChanged.connect(self.schedule_preview)
+        self.preview_checkbox.toggled.connect(self.schedule_preview)
+
         # Set layout
         input_layout = QtWidgets.QGridLayout()
         input_layout.addWidget(self.prompt_label, 0, 0)
@@ -77,10 +89,12 @@ class TextToImageApp(QtWidgets.QWidget):
         input_layout.addWidget(self.engine_id_dropdown, 3, 1)
         input_layout.addWidget(self.filename_label, 4, 0)
         input_layout.addWidget(self.filename_input, 4, 1)
+        input_layout.addWidget(self.preview_checkbox, 5, 1)
 
         layout = QtWidgets.QVBoxLayout()
         layout.addLayout(input_layout)
         layout.addWidget(self.generate_button)
+        layout.addWidget(self.status_label)
         layout.addWidget(self.image_label)
         self.setLayout(layout)
 
@@ -94,46 +108,180 @@ class TextToImageApp(QtWidgets.QWidget):
         style_preset = self.style_preset_dropdown.currentText()
         engine_id = self.engine_id_dropdown.currentText()
 
-        # Make the API request
-        if self.api_key is None:
-            raise Exception("Missing Stability API key.")
-
-        response = requests.post(
-            f"{self.api_host}/v1/generation/{engine_id}/text-to-image",
-            headers={
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-                "Authorization": f"Bearer {self.api_key}"
-            },
-            json={
-                "text_prompts": [
-                    {
-                        "text": prompt,
-                        "weight": 1.0
-                    }
-                ],
-                "cfg_scale": 7,
-                "clip_guidance_preset": "FAST_BLUE",
-                "samples": 1,
-                "style_preset": style_preset,
-            },
-        )
-
-        if response.status_code != 200:
-            raise Exception("Non-200 response: " + str(response.text))
-
-        data = response.json()
-
-        # Save the resulting image to a file
-        image_data = base64.b64decode(data["artifacts"][0]["base64"])
-        with open(filename, "wb") as f:
-            f.write(image_data)
+        # Upgrade the preview on screen: same settings and seed, full steps
+        seed = None
+        preview = self.previews.get(self.preview_key())
+        if self.preview_checkbox.isChecked() and preview is not None:
+            seed = preview[1]
+        # A preview still to come would only replace the full image on screen
+        self.preview_timer.stop()
+        self.preview_queued = False
+        if self.preview_job is not None:
+            self.preview_job.cancel()
+
+        # Make the API request in the background so the window stays responsive
+        self.generate_button.setEnabled(False)
+        self.status_label.setText("Generating...")
+        job = self.job_runner.submit(self.request_image, prompt, filename, style_preset, engine_id, seed)
+        job.signals.result.connect(self.display_image)
+        job.signals.result.connect(lambda filename: self.status_label.setText(f"Saved {filename}"))
+        job.signals.error.connect(self.show_error)
+        job.signals.finished.connect(lambda: self.generate_button.setEnabled(True))
+
+    def build_payload(self, prompt, style_preset, seed=None, steps=None):
+        payload = {
+            "text_prompts": [
+                {
+                    "text": prompt,
+                    "weight": 1.0
+                }
+            ],
+            "cfg_scale": 7,
+            "clip_guidance_preset": "FAST_BLUE",
+            "samples": 1,
+            "style_preset": style_preset,
+        }
+        if seed is not None:
+            payload["seed"] = seed
+        if steps is not None:
+            payload["steps"] = steps
+        return payload
+
+    def request_image(self, job, prompt, filename, style_preset, engine_id, seed=None):
+        # Runs on a job runner thread; must not touch any widgets
+        provider = self.load_backend()
+        payload = self.build_payload(prompt, style_preset, seed)
+
+        # Stream the resulting image straight into the file
+        start = time.perf_counter()
+        artifact = provider.generate_file(engine_id, payload, filename)
+        self.catalog.add(filename, {
+            "prompt": prompt,
+            "engine_id": engine_id,
+            "style_preset": style_preset,
+            "cfg_scale": payload["cfg_scale"],
+            "seed": artifact.get("seed"),
+        }, seconds=time.perf_counter() - start)
+
+        return filename
+
+    def load_backend(self, priority="interactive"):
+        # Returns the provider for one request. A preview and a full generation
+        # may both get here first.
+        with self.backend_lock:
+            if self.catalog is None:
+                from catalog import Catalog
+
+                self.catalog = Catalog()
+            # Through the generation daemon if one runs, ahead of any batch work;
+            # probed per request, so a daemon stopped since is not used
+            provider = connect_daemon(priority)
+            if provider is not None:
+                return provider
+            if self.direct_provider is None:
+                self.api_key = read_api_key()
+                self.direct_provider = StabilityProvider(self.api_key, self.api_host)
+            return self.direct_provider
 
+    def preview_key(self):
+        return (self.prompt_input.text().strip(), self.style_preset_dropdown.currentText(),
+                self.engine_id_dropdown.currentText())
+
+    def schedule_preview(self):
+        if self.preview_job is not None:
+            # Stale now: its result is dropped when it finishes
+            self.preview_job.cancel()
+        self.preview_queued = False
+        if not self.preview_checkbox.isChecked() or not self.preview_key()[0]:
+            self.preview_timer.stop()
+            return
+        self.preview_timer.start()
+
+    def start_preview(self):
+        key = self.preview_key()
+        if not self.preview_checkbox.isChecked() or not key[0]:
+            return
+        if key in self.previews:
+            self.previews.move_to_end(key)
+            self.show_preview(self.previews[key][0])
+            return
+        if self.preview_job is not None:
+            # One preview in flight at a time; the current settings go next
+            self.preview_queued = True
+            return
+
+        if self.preview_dir is None:
+            self.preview_dir = tempfile.mkdtemp(prefix="dsimg-preview-")
+        fd, path = tempfile.mkstemp(dir=self.preview_dir, suffix=".png")
+        os.close(fd)
+        self.status_label.setText("Generating preview...")
+        job = self.preview_runner.submit(self.request_preview, key, path, random.randrange(2 ** 32))
+        job.signals.result.connect(self.preview_ready)
+        job.signals.error.connect(lambda message: self.status_label.setText(f"Preview failed: {message}"))
+        job.signals.cancelled.connect(lambda: self.discard_preview(path))
+        job.signals.finished.connect(self.preview_finished)
+        self.preview_job = job
+
+    def preview_finished(self):
+        self.preview_job = None
+        if self.preview_queued:
+            self.preview_queued = False
+            self.start_preview()
+
+    def request_preview(self, job, key, path, seed):
+        # Runs on the preview thread. A preview that went stale before it
+        # started is never sent; one that goes stale in flight is not retried
+        # and its result is dropped (the job then reports cancelled).
+        if job.is_cancelled():
+            return None
+        # Below full generations at the daemon, so previews never take the
+        # worker it keeps free for them
+        provider = self.load_backend("preview")
+        prompt, style_preset, engine_id = key
+        payload = self.build_payload(prompt, style_preset, seed, steps=PREVIEW_STEPS)
+        provider.generate_file(engine_id, payload, path, should_stop=job.is_cancelled)
+        return key, path, seed
+
+    def preview_ready(self, result):
+        key, path, seed = result
+        self.previews[key] = (path, seed)
+        self.previews.move_to_end(key)
+        while len(self.previews) > PREVIEW_CACHE_SIZE:
+            old_path, _ = self.previews.popitem(last=False)[1]
+            os.remove(old_path)
+        if key == self.preview_key():
+            self.show_preview(path)
+
+    def discard_preview(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    def show_preview(self, path):
+        self.display_image(path)
+        self.status_label.setText(f"Preview ({PREVIEW_STEPS} steps); Generate makes the full image")
+
+    def display_image(self, filename):
         # Display the resulting image
-        image = QtGui.QPixmap()
-        image.loadFromData(image_data)
+        image = QtGui.QPixmap(filename)
         self.image_label.setPixmap(image.scaled(self.image_label.width(), self.image_label.height(), QtCore.Qt.KeepAspectRatio))
 
+    def show_error(self, message):
+        self.status_label.setText("Generation failed")
+        QtWidgets.QMessageBox.warning(self, "Generation failed", message)
+
+    def closeEvent(self, event):
+        self.preview_timer.stop()
+        self.preview_queued = False
+        if self.preview_job is not None:
+            self.preview_job.cancel()
+        self.preview_runner.shutdown()
+        self.job_runner.shutdown()
+        if self.catalog is not None:
+            self.catalog.flush()
+        if self.preview_dir is not None:
+            shutil.rmtree(self.preview_dir, ignore_errors=True)
+        super().closeEvent(event)
+
 if __name__ == '__main__':
     app = QtWidgets.QApplication([])
     text_to_image_app = TextToImageApp()
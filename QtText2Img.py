@@ -5,15 +5,23 @@
 
 
 import sys
-import requests
+import time
 from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import QApplication, QWidget, QLabel, QLineEdit, QPushButton, QVBoxLayout, QHBoxLayout, QFileDialog, QGraphicsScene, QGraphicsView
 from PyQt5.QtGui import QPixmap
 
+from generation_settings import read_api_key
+from job_runner import JobRunner
+from providers import DeepAIProvider, connect_daemon
+
 class Text2ImgGUI(QWidget):
     def __init__(self):
         super().__init__()
 
+        self.job_runner = JobRunner(parent=self)
+        # Opened by the first image created
+        self.catalog = None
+
         # Set up the UI
         self.initUI()
 
@@ -46,8 +54,8 @@ class Text2ImgGUI(QWidget):
         filename_layout.addWidget(browse_button)
 
         # Create image button
-        create_image_button = QPushButton("Create Image")
-        create_image_button.clicked.connect(self.create_image_button_clicked)
+        self.create_image_button = QPushButton("Create Image")
+        self.create_image_button.clicked.connect(self.create_image_button_clicked)
 
         # Image display
         self.image_scene = QGraphicsScene()
@@ -57,7 +65,7 @@ class Text2ImgGUI(QWidget):
         main_layout.addLayout(image_desc_layout)
         main_layout.addLayout(neg_prompt_layout)
         main_layout.addLayout(filename_layout)
-        main_layout.addWidget(create_image_button)
+        main_layout.addWidget(self.create_image_button)
         main_layout.addWidget(self.image_view)
 
         self.setLayout(main_layout)
@@ -75,43 +83,54 @@ class Text2ImgGUI(QWidget):
         negative_prompt = self.neg_prompt_input.text()
         filename = self.filename_input.text()
 
-        # Read API key from file
+        # Read API key from file; not needed when a generation daemon runs
         try:
-            with open("api_key.txt", "r") as api_key_file:
-                api_key = api_key_file.read().strip()
+            api_key = read_api_key()
         except FileNotFoundError:
-            print("Error: api_key.txt not found")
-            return
+            api_key = None
 
         # Check for required inputs
         if not image_description or not negative_prompt or not filename:
             print("Error: Please provide all required inputs")
             return
 
-        # Call the create_image function
-        self.create_image(image_description, negative_prompt, filename, api_key)
-
-        # Display the created image
-        self.display_image(filename)
-
-    def create_image(self, image_description, negative_prompt, filename, api_key):
-        # Create the request
-        request = requests.post("https://api.deepai.org/api/text2img",
-                                data={"text": image_description, "negative_prompt": negative_prompt, "grid_size":"1"},
-                                headers={'api-key':api_key})
-
-        # Check the response status code
-        if request.status_code == 200:
-            # Get the image data
-            image_url = request.json()["output_url"]
-
-            # Save the image to a file
-            with open(filename, "wb") as f:
-                f.write(requests.get(image_url).content)
-
-            print("Image created successfully!")
-        else:
-            print("Error creating image: {}".format(request.status_code))
+        # Call the create_image function in the background, then display the created image
+        self.create_image_button.setEnabled(False)
+        job = self.job_runner.submit(self.create_image, image_description, negative_prompt, filename, api_key)
+        job.signals.result.connect(self.display_image)
+        job.signals.error.connect(lambda message: print("Error creating image: {}".format(message)))
+        job.signals.finished.connect(lambda: self.create_image_button.setEnabled(True))
+
+    def create_image(self, job, image_description, negative_prompt, filename, api_key):
+        # The negative prompt travels as a negatively weighted text prompt
+        payload = {
+            "text_prompts": [
+                {"text": image_description, "weight": 1.0},
+                {"text": negative_prompt, "weight": -1.0},
+            ],
+        }
+
+        # Create the image and save it to a file
+        # Through the generation daemon if one runs, ahead of any batch work
+        provider = connect_daemon("interactive", "deepai")
+        if provider is None:
+            if api_key is None:
+                raise Exception("api_key.txt not found")
+            provider = DeepAIProvider(api_key)
+
+        start = time.perf_counter()
+        provider.generate_file(None, payload, filename)
+        if self.catalog is None:
+            from catalog import Catalog
+            self.catalog = Catalog()
+        self.catalog.add(filename, {
+            "prompt": image_description,
+            "negative_prompt": negative_prompt,
+            "engine_id": "deepai",
+        }, seconds=time.perf_counter() - start)
+
+        print("Image created successfully!")
+        return filename
 
     def display_image(self, filename):
         # Load the image
@@ -123,6 +142,12 @@ class Text2ImgGUI(QWidget):
         self.image_view.setScene(self.image_scene)
         self.image_view.fitInView(self.image_scene.itemsBoundingRect(), mode=Qt.KeepAspectRatio)
 
+    def closeEvent(self, event):
+        self.job_runner.shutdown()
+        if self.catalog is not None:
+            self.catalog.flush()
+        super().closeEvent(event)
+
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     gui = Text2ImgGUI()
@@ -0,0 +1,216 @@
+# Shared HTTP client for the Stability and DeepAI front-ends
+# One pooled requests.Session per process, so consecutive images reuse
+# keep-alive connections instead of paying a TCP+TLS handshake each time.
+# requests is only imported once the first client is created, which keeps it
+# off the front-ends' startup path.
+
+import os
+import tempfile
+import threading
+import time
+
+from metrics import metrics
+from stream_decode import ArtifactStreamDecoder
+
+DEFAULT_POOL_SIZE = int(os.getenv("API_POOL_SIZE", "16"))
+DEFAULT_CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", "10"))
+DEFAULT_READ_TIMEOUT = float(os.getenv("API_READ_TIMEOUT", "180"))
+
+DEEPAI_HOST = os.getenv("DEEPAI_HOST", "https://api.deepai.org")
+
+# Response bodies are read in chunks of this size, never as a whole
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class ApiError(Exception):
+    def __init__(self, message, status_code, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def raise_for_api_status(response, message):
+    if response.status_code != 200:
+        raise ApiError(message, response.status_code, parse_retry_after(response.headers.get("Retry-After")))
+
+
+def write_atomically(filename, write):
+    # Run write(f) against a temp file next to filename and only move it into
+    # place if it succeeds, so a failed or retried request never leaves a partial image
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            result = write(f)
+        os.replace(tmp_path, filename)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return result
+
+
+class ApiClient:
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)):
+        import requests
+
+        self.timeout = timeout
+        self.pool_size = 0
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.headers["Connection"] = "keep-alive"
+        self.ensure_pool_size(pool_size)
+
+    def ensure_pool_size(self, pool_size):
+        # Grow the connection pool so every concurrent worker can keep its own
+        # connection open; never shrinks
+        from requests.adapters import HTTPAdapter
+
+        with self._lock:
+            if pool_size <= self.pool_size:
+                return
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+            self.pool_size = pool_size
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.post(url, **kwargs)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def stability_text_to_image(self, api_host, api_key, engine_id, payload, open_artifact):
+        # Artifacts are decoded straight into the files returned by
+        # open_artifact(index); returns the response with the image data removed
+        return self.stability_receive(self.stability_submit(api_host, api_key, engine_id, payload), open_artifact)
+
+    def stability_submit(self, api_host, api_key, engine_id, payload, headers=None):
+        # Sends the request and returns the response once its headers are in;
+        # the body is left unread for stability_receive()
+        start = time.perf_counter()
+        metrics.incr("requests")
+        request_headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        }
+        if headers:
+            request_headers.update(headers)
+        response = self.post(
+            f"{api_host}/v1/generation/{engine_id}/text-to-image",
+            headers=request_headers,
+            json=payload,
+            stream=True,
+        )
+        response.submitted_at = start
+        response.trace_args = {"engine_id": engine_id, "samples": payload.get("samples", 1)}
+
+        if response.status_code != 200:
+            with response:
+                metrics.incr(f"http_{response.status_code}")
+                raise_for_api_status(response, "Non-200 response: " + str(response.text))
+        return response
+
+    def stability_receive(self, response, open_artifact):
+        start = response.submitted_at
+        network = time.perf_counter() - start
+
+        with response:
+            # Split the body phase into time blocked on the socket, time decoding
+            # base64 and time spent in file writes
+            decoder = ArtifactStreamDecoder(open_artifact)
+            feed_seconds = 0.0
+            chunks = response.iter_content(STREAM_CHUNK_SIZE)
+            while True:
+                waited = time.perf_counter()
+                chunk = next(chunks, None)
+                fed = time.perf_counter()
+                network += fed - waited
+                if chunk is None:
+                    break
+                metrics.incr("bytes_received", len(chunk))
+                decoder.feed(chunk)
+                feed_seconds += time.perf_counter() - fed
+
+            parsed = time.perf_counter()
+            data = decoder.finish()
+            parse_seconds = time.perf_counter() - parsed
+
+        metrics.incr("bytes_written", decoder.bytes_written)
+        metrics.add_time("network", network)
+        metrics.add_time("decode", feed_seconds - decoder.write_seconds)
+        metrics.add_time("write", decoder.write_seconds)
+        metrics.add_time("json_parse", parse_seconds)
+        trace_args = dict(response.trace_args)
+        trace_args.update({
+            "network_ms": round(network * 1000, 1),
+            "decode_ms": round((feed_seconds - decoder.write_seconds) * 1000, 1),
+            "write_ms": round(decoder.write_seconds * 1000, 1),
+        })
+        metrics.add_time("request", time.perf_counter() - start, start, trace_args)
+        return data
+
+    def stability_text_to_image_file(self, api_host, api_key, engine_id, payload, filename):
+        # Single-sample convenience wrapper: writes the first artifact to filename
+        return write_atomically(filename, lambda f: self.stability_text_to_image(
+            api_host, api_key, engine_id, payload, lambda index: f if index == 0 else None))
+
+    def deepai_text2img(self, api_key, text, negative_prompt, grid_size="1", host=None):
+        metrics.incr("requests")
+        with metrics.span("network", api="deepai"):
+            response = self.post(
+                f"{host or DEEPAI_HOST}/api/text2img",
+                data={"text": text, "negative_prompt": negative_prompt, "grid_size": grid_size},
+                headers={'api-key': api_key},
+            )
+
+        raise_for_api_status(response, "Non-200 response: " + str(response.status_code))
+
+        return response.json()["output_url"]
+
+    def download(self, url, filename):
+        # Stream the body to disk instead of holding it in memory
+        write_atomically(filename, lambda f: self.download_to(url, f))
+
+    def download_to(self, url, f):
+        metrics.incr("requests")
+        with metrics.span("download"), self.get(url, stream=True) as response:
+            raise_for_api_status(response, "Download failed: " + str(response.status_code))
+            for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                metrics.incr("bytes_received", len(chunk))
+                f.write(chunk)
+
+
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+
+def get_client(pool_size=None):
+    # Process-wide client shared by every front-end and worker thread
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            _shared_client = ApiClient()
+    if pool_size is not None:
+        _shared_client.ensure_pool_size(pool_size)
+    return _shared_client
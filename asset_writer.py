@@ -0,0 +1,139 @@
+# Background writer stage for finished images
+# Request threads hand over a completed temp file and get a Future back; a
+# single writer thread picks the final name, optionally fsyncs, and renames the
+# file into place. Names come from an in-memory index of the output directory,
+# listed once, so a collision costs a set lookup rather than an exists() probe
+# per candidate. The index assumes nothing else writes into the directory while
+# a batch runs.
+
+import os
+import queue
+import threading
+from concurrent.futures import Future
+
+from metrics import metrics
+
+# Queued images before submit() blocks, so a slow disk pushes back on requests
+DEFAULT_QUEUE_SIZE = 256
+
+# With fsync on, up to this many queued images share one directory fsync
+DEFAULT_FSYNC_BATCH = 32
+
+
+class NameIndex:
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        with os.scandir(directory) as entries:
+            self._names = {entry.name for entry in entries}
+        # (stem, ext) -> next collision suffix to try
+        self._next_suffix = {}
+
+    def allocate(self, filename, number=None):
+        # The numbered name if there is one, else filename; when taken,
+        # filename_001, filename_002, ... The name is reserved on return.
+        stem, ext = os.path.splitext(filename)
+        name = filename if number is None else f"{number:04}_{stem}{ext}"
+        with self._lock:
+            if name not in self._names:
+                # Numbers are unique within a run, so a free numbered name can only
+                # clash with files that were already there; not remembering them
+                # keeps the index from growing over a long run
+                if number is None:
+                    self._names.add(name)
+                return os.path.join(self.directory, name)
+            i = self._next_suffix.get((stem, ext), 1)
+            while f"{stem}_{i:03}{ext}" in self._names:
+                i += 1
+            name = f"{stem}_{i:03}{ext}"
+            self._next_suffix[(stem, ext)] = i + 1
+            self._names.add(name)
+        return os.path.join(self.directory, name)
+
+    def release(self, path):
+        with self._lock:
+            self._names.discard(os.path.basename(path))
+
+
+def _fsync_path(path, flags=os.O_RDONLY):
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class AssetWriter:
+    def __init__(self, output_dir, fsync=False, fsync_batch=DEFAULT_FSYNC_BATCH, queue_size=DEFAULT_QUEUE_SIZE):
+        self.output_dir = output_dir
+        self.fsync = fsync
+        self.fsync_batch = max(1, fsync_batch)
+        self.index = NameIndex(output_dir)
+        self._queue = queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._run, name="asset-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, tmp_path, filename, number=None):
+        # Moves tmp_path (in the output dir) to its final name; the Future
+        # resolves to the final path
+        future = Future()
+        self._queue.put((tmp_path, filename, number, future))
+        return future
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            # Take whatever else is already queued so one directory fsync covers it all
+            while self.fsync and len(batch) < self.fsync_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._write_batch(batch)
+                    return
+                batch.append(item)
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        written = []
+        for tmp_path, filename, number, future in batch:
+            with metrics.span("finalize"):
+                output_path = self.index.allocate(filename, number)
+                try:
+                    if self.fsync:
+                        _fsync_path(tmp_path)
+                    os.replace(tmp_path, output_path)
+                except Exception as e:
+                    self.index.release(output_path)
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    future.set_exception(e)
+                    continue
+            written.append((future, output_path))
+
+        if self.fsync and written:
+            # Make the renames themselves durable before reporting the files as done
+            with metrics.span("fsync", files=len(written)):
+                try:
+                    _fsync_path(self.output_dir, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+                except OSError:
+                    # Not every platform can fsync a directory
+                    pass
+        for future, output_path in written:
+            future.set_result(output_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        # Waits for everything queued so far to be written
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
@@ -3,13 +3,35 @@
 # Robert Schauer 25-Apr-2023
 # With assistance from ChatGPT
 
-import requests
-import json
 import os
-import base64
-from qtpy import QtWidgets, QtGui, QtCore
+from collections import deque
+from functools import cached_property
+from qtpy import QtWidgets, QtCore
 from qtpy.QtWidgets import QSpinBox
 
+# Only light modules are imported at startup; the engine (and with it the HTTP
+# client), the result cache and the catalog are loaded on first use
+from generation_settings import (
+    DEFAULT_ENGINE_ID,
+    DEFAULT_STYLE_PRESET,
+    ENGINE_IDS,
+    STYLE_PRESETS,
+    default_size,
+    make_settings,
+    read_api_key,
+)
+from job_journal import JobJournal, completed_units, load_journal
+from job_runner import JobRunner
+from metrics import metrics
+from postprocess import FORMATS, PostProcessError, PostProcessOptions, check_options
+from prompt_preview import PromptPreview
+from prompt_source import PromptSource
+from providers import MAX_SAMPLES, connect_daemon, load_providers
+from thumbnail_gallery import ThumbnailGallery
+
+PROVIDERS_FILE = "providers.json"
+
+
 class TextToImageApp(QtWidgets.QWidget):
     def __init__(self):
         super().__init__()
@@ -20,60 +42,33 @@ class TextToImageApp(QtWidgets.QWidget):
         # Set window dimensions
         self.setGeometry(100, 100, 900, 1200)
 
-        self.engine_id = "stable-diffusion-512-v2-1"
+        self.engine_id = DEFAULT_ENGINE_ID
         self.api_host = os.getenv("API_HOST", "https://api.stability.ai")
 
-        # Read the API key from api_key.txt
-        with open("api_key.txt", "r") as f:
-            self.api_key = f.readline().strip()
+        # Loaded by load_backend() when the first batch starts; provider is
+        # the daemon or direct_provider, whichever the latest batch uses
+        self.provider = None
+        self.direct_provider = None
+        self.api_key = None
 
         # Create UI elements
         self.filename_label = QtWidgets.QLabel("No file selected.")
         self.filename_label.setAlignment(QtCore.Qt.AlignCenter)
         self.filename_label.setMinimumHeight(50)
 
-        self.file_list_widget = QtWidgets.QListWidget()
-        self.file_list_widget.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
-        self.file_list_widget.setFixedHeight(200)  # Set fixed height
+        self.prompt_preview = PromptPreview()
+        self.prompt_preview.setFixedHeight(200)  # Set fixed height
 
         self.browse_button = QtWidgets.QPushButton("Browse")
         self.browse_button.clicked.connect(self.browse_file)
 
         self.style_preset_label = QtWidgets.QLabel("Select a style preset:")
         self.style_preset_dropdown = QtWidgets.QComboBox()
-        self.style_preset_dropdown.addItems([
-            "3d-model",
-            "analog-film",
-            "anime",
-            "cinematic",
-            "comic-book",
-            "digital-art",
-            "enhance",
-            "fantasy-art",
-            "isometric",
-            "line-art",
-            "low-poly",
-            "modeling-compound",
-            "neon-punk",
-            "origami",
-            "photographic",
-            "pixel-art",
-            "tile-texture"
-        ])
+        self.style_preset_dropdown.addItems(STYLE_PRESETS)
 
         self.engine_id_label = QtWidgets.QLabel("Select an engine ID:")
         self.engine_id_dropdown = QtWidgets.QComboBox()
-        self.engine_id_dropdown.addItems([
-            "stable-diffusion-v1",
-            "stable-diffusion-v1-5",
-            "stable-diffusion-512-v2-0",
-            "stable-diffusion-768-v2-0",
-            "stable-diffusion-512-v2-1",
-            "stable-diffusion-768-v2-1",
-            "stable-diffusion-xl-beta-v2-2-2",
-            "stable-inpainting-v1-0",
-            "stable-inpainting-512-v2-0"
-        ])
+        self.engine_id_dropdown.addItems(ENGINE_IDS)
 
         self.output_dir_label = QtWidgets.QLabel("Output directory:")
         self.output_dir_label.setAlignment(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
@@ -85,16 +80,27 @@ class TextToImageApp(QtWidgets.QWidget):
         self.output_dir_button.clicked.connect(self.select_output_dir)
 
         self.generate_button = QtWidgets.QPushButton("Generate")
+        self.resume_button = QtWidgets.QPushButton("Resume")
+        self.resume_button.clicked.connect(self.resume_generation)
+        self.cancel_button = QtWidgets.QPushButton("Cancel")
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel_generation)
 
-        self.image_scroll_area = QtWidgets.QScrollArea()
-        self.image_scroll_area.setWidgetResizable(True)
-        self.image_scroll_area_widget = QtWidgets.QWidget()
-        self.image_scroll_area_layout = QtWidgets.QVBoxLayout(self.image_scroll_area_widget)
-        self.image_scroll_area.setWidget(self.image_scroll_area_widget)
+        # Thumbnails of generated images; double-click opens the full-size file
+        self.gallery = ThumbnailGallery()
 
         self.status_label = QtWidgets.QLabel()
         self.status_label.setAlignment(QtCore.Qt.AlignCenter)
 
+        # Live per-stage timings and counters, refreshed while a batch runs
+        self.metrics_label = QtWidgets.QLabel()
+        self.metrics_label.setAlignment(QtCore.Qt.AlignCenter)
+        self.export_metrics_button = QtWidgets.QPushButton("Export metrics")
+        self.export_metrics_button.clicked.connect(self.export_metrics)
+        self.metrics_timer = QtCore.QTimer(self)
+        self.metrics_timer.setInterval(500)
+        self.metrics_timer.timeout.connect(self.update_metrics)
+
         # Add a numbering scheme checkbox
         self.numbering_checkbox = QtWidgets.QCheckBox("Enable numbering scheme")
         self.numbering_checkbox.setChecked(True)
@@ -113,6 +119,42 @@ class TextToImageApp(QtWidgets.QWidget):
         self.cfg_scale_spin_box.setMaximum(35)
         self.cfg_scale_spin_box.setValue(7)
 
+        # Add a new label and spin box for the number of concurrent requests
+        self.concurrency_label = QtWidgets.QLabel("Concurrent requests:")
+        self.concurrency_spin_box = QSpinBox()
+        self.concurrency_spin_box.setMinimum(1)
+        self.concurrency_spin_box.setMaximum(32)
+        self.concurrency_spin_box.setValue(4)
+
+        # Add a new label and spin box for batching iterations into multi-sample requests
+        self.samples_label = QtWidgets.QLabel("Samples per request:")
+        self.samples_spin_box = QSpinBox()
+        self.samples_spin_box.setMinimum(1)
+        self.samples_spin_box.setMaximum(MAX_SAMPLES)
+        self.samples_spin_box.setValue(1)
+
+        # Add a dropdown and checkbox for post-processing the generated images
+        self.format_label = QtWidgets.QLabel("Output format:")
+        self.format_dropdown = QtWidgets.QComboBox()
+        self.format_dropdown.addItems(FORMATS)
+        self.embed_metadata_checkbox = QtWidgets.QCheckBox("Embed generation parameters")
+        self.embed_metadata_checkbox.setChecked(False)
+
+        # Add a checkbox to bypass the result cache
+        self.force_regenerate_checkbox = QtWidgets.QCheckBox("Force regenerate (ignore cache)")
+        self.force_regenerate_checkbox.setChecked(False)
+
+        # Every saved image is recorded in the catalog, searchable from its own window
+        self.catalog_panel = None
+        self.catalog_button = QtWidgets.QPushButton("Search catalog")
+        self.catalog_button.clicked.connect(self.show_catalog)
+
+        self.job_runner = JobRunner(parent=self)
+        self.failed_count = 0
+        # Only the latest failures are kept for the tooltip; all of them are journaled
+        self.failed_units = deque(maxlen=20)
+        self.current_job = None
+
         # Connect button to function that generates the image
         self.generate_button.clicked.connect(self.generate_image)
 
@@ -125,19 +167,27 @@ class TextToImageApp(QtWidgets.QWidget):
         input_layout.addWidget(self.engine_id_label, 2, 0)
         input_layout.addWidget(self.engine_id_dropdown, 2, 1)
         input_layout.addWidget(self.numbering_checkbox, 3, 0)  # Add numbering scheme checkbox
+        input_layout.addWidget(self.force_regenerate_checkbox, 3, 1)
         input_layout.addWidget(self.iterations_label, 4, 0)
         input_layout.addWidget(self.iterations_spin_box, 4, 1)
         input_layout.addWidget(self.cfg_scale_label, 5, 0)  # Add cfg_scale label
         input_layout.addWidget(self.cfg_scale_spin_box, 5, 1)  # Add cfg_scale spin box
+        input_layout.addWidget(self.concurrency_label, 6, 0)
+        input_layout.addWidget(self.concurrency_spin_box, 6, 1)
+        input_layout.addWidget(self.samples_label, 7, 0)
+        input_layout.addWidget(self.samples_spin_box, 7, 1)
+        input_layout.addWidget(self.format_label, 8, 0)
+        input_layout.addWidget(self.format_dropdown, 8, 1)
+        input_layout.addWidget(self.embed_metadata_checkbox, 9, 1)
 
         # Set the default value for the style_preset_dropdown
-        default_style_preset = "enhance"
+        default_style_preset = DEFAULT_STYLE_PRESET
         default_style_preset_index = self.style_preset_dropdown.findText(default_style_preset)
         if default_style_preset_index != -1:
             self.style_preset_dropdown.setCurrentIndex(default_style_preset_index)
 
         # Set the default value for the engine_id_dropdown
-        default_engine_id = "stable-diffusion-512-v2-1"
+        default_engine_id = DEFAULT_ENGINE_ID
         default_engine_id_index = self.engine_id_dropdown.findText(default_engine_id)
         if default_engine_id_index != -1:
             self.engine_id_dropdown.setCurrentIndex(default_engine_id_index)
@@ -149,15 +199,23 @@ class TextToImageApp(QtWidgets.QWidget):
 
         button_layout = QtWidgets.QHBoxLayout()
         button_layout.addWidget(self.generate_button)
+        button_layout.addWidget(self.resume_button)
+        button_layout.addWidget(self.cancel_button)
 
         main_layout = QtWidgets.QVBoxLayout()
         main_layout.addLayout(input_layout)
-        main_layout.addWidget(self.file_list_widget)
+        main_layout.addWidget(self.prompt_preview)
         main_layout.addLayout(output_layout)
         main_layout.addLayout(button_layout)
-        main_layout.addWidget(self.image_scroll_area)
+        main_layout.addWidget(self.gallery)
         main_layout.addWidget(self.status_label)
 
+        metrics_layout = QtWidgets.QHBoxLayout()
+        metrics_layout.addWidget(self.metrics_label, 1)
+        metrics_layout.addWidget(self.export_metrics_button)
+        metrics_layout.addWidget(self.catalog_button)
+        main_layout.addLayout(metrics_layout)
+
         self.setLayout(main_layout)
         
         # Center the window on the screen
@@ -172,15 +230,14 @@ class TextToImageApp(QtWidgets.QWidget):
 
     def browse_file(self):
         file_dialog = QtWidgets.QFileDialog(self)
-        file_dialog.setNameFilter("Text files (*.txt)")
+        file_dialog.setNameFilter("Prompt files (*.txt *.csv *.jsonl);;All files (*)")
         file_dialog.setFileMode(QtWidgets.QFileDialog.ExistingFile)
         if file_dialog.exec_():
             filename = file_dialog.selectedFiles()[0]
             self.filename_label.setText(filename)
-            self.file_list_widget.clear()
-            with open(filename, 'r') as f:
-                for line in f:
-                    self.file_list_widget.addItem(line.strip())
+            # Only the rows scrolled into view are read from the file
+            width, height = default_size(self.engine_id_dropdown.currentText())
+            self.prompt_preview.set_source(PromptSource(filename, width, height))
 
     def select_output_dir(self):
         dir_dialog = QtWidgets.QFileDialog(self)
@@ -190,111 +247,224 @@ class TextToImageApp(QtWidgets.QWidget):
 
     def generate_image(self):
         # Get the prompt list, style_preset, and engine_id from the user
-        filename = self.filename_label.text()
-        style_preset = self.style_preset_dropdown.currentText()
-        engine_id = self.engine_id_dropdown.currentText()
-
-        # Set the default width and height based on the engine_id
-        if '768' in engine_id:
-            width = 768
-            height = 768
-        else:
-            width = 512
-            height = 512
-
-        # Read the contents of the file into a list of prompts
-        prompt_list = []
-        with open(filename, 'r') as f:
-            for line in f:
-                prompt = line.strip()
-                prompt_filename = prompt.replace(" ", "_") + ".png"
-                prompt_list.append({
-                    "text": prompt,
-                    "filename": prompt_filename,
-                    "width": width,
-                    "height": height,
-                })
-
+        settings = make_settings(
+            self.filename_label.text(),
+            self.engine_id_dropdown.currentText(),
+            self.style_preset_dropdown.currentText(),
+            self.cfg_scale_spin_box.value(),
+            self.iterations_spin_box.value(),
+            numbering=self.numbering_checkbox.isChecked(),
+        )
+
+        self.start_batch(settings, self.output_dir_textbox.text(), completed=set())
+
+    def resume_generation(self):
+        # Pick up the last journaled run in the output directory, submitting only unfinished units
         output_dir = self.output_dir_textbox.text()
+        journal_state = load_journal(output_dir)
+        if journal_state is None:
+            self.status_label.setText(f"No batch journal found in {output_dir}")
+            return
+
+        settings, units = journal_state
+        self.filename_label.setText(settings["filename"])
+        self.start_batch(settings, output_dir, completed=completed_units(units), resume=True)
+
+    @cached_property
+    def result_cache(self):
+        from result_cache import ResultCache
+        return ResultCache()
+
+    @cached_property
+    def catalog(self):
+        from catalog import Catalog
+        return Catalog()
+
+    def load_backend(self):
+        # A running generation daemon queues the batch behind interactive
+        # requests from the other front-ends. Without one, a providers.json
+        # next to the app fans batches out over several providers/API keys;
+        # otherwise the single key in api_key.txt is used. The daemon is probed
+        # again for every batch, so one stopped since the last batch is not used.
+        self.provider = connect_daemon("batch")
+        if self.provider is not None:
+            return
+        if self.direct_provider is None and self.api_key is None:
+            if os.path.exists(PROVIDERS_FILE):
+                self.direct_provider = load_providers(PROVIDERS_FILE)
+            else:
+                self.api_key = read_api_key()
+        self.provider = self.direct_provider
+
+    def start_batch(self, settings, output_dir, completed, resume=False):
+        from batch_engine import engine_from_settings, read_prompt_list
+
+        # Check everything before touching the journal: a new "start" record
+        # hides the previous run from Resume
+        if not os.path.isfile(settings["filename"]):
+            self.status_label.setText("Error: select a prompt file first."
+                                      if not resume else f"Error: prompt file not found: {settings['filename']}")
+            return
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+            self.load_backend()
+        except (OSError, ValueError) as e:
+            self.status_label.setText(f"Error: {e}")
+            return
+        postprocess = PostProcessOptions(
+            self.format_dropdown.currentText(),
+            embed_metadata=self.embed_metadata_checkbox.isChecked(),
+        )
+        if postprocess.enabled:
+            try:
+                check_options(postprocess)
+            except PostProcessError as e:
+                self.status_label.setText(f"Error: {e}")
+                return
+
+        prompt_list = read_prompt_list(settings["filename"], settings["width"], settings["height"])
+
+        engine = engine_from_settings(
+            settings,
+            self.api_host,
+            self.api_key,
+            output_dir,
+            provider=self.provider,
+            concurrency=self.concurrency_spin_box.value(),
+            samples_per_request=self.samples_spin_box.value(),
+            cache=self.result_cache,
+            force_regenerate=self.force_regenerate_checkbox.isChecked(),
+            catalog=self.catalog,
+            postprocess=postprocess,
+        )
+
+        journal = JobJournal(output_dir)
+        if resume:
+            journal.resume()
+        else:
+            journal.start(settings)
+
+        # Run the batch on the job runner so the window keeps repainting
+        self.failed_count = 0
+        self.failed_units.clear()
+        self.generate_button.setEnabled(False)
+        self.resume_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self.current_job = self.job_runner.submit(
+            self.run_batch, engine, prompt_list, settings["iterations"], journal, completed)
+        self.current_job.signals.result.connect(self.show_image)
+        self.current_job.signals.status.connect(self.show_status)
+        self.current_job.signals.progress.connect(self.show_progress)
+        self.current_job.signals.warning.connect(self.unit_failed)
+        self.current_job.signals.error.connect(self.generation_failed)
+        self.current_job.signals.cancelled.connect(self.generation_cancelled)
+        self.current_job.signals.finished.connect(self.generation_finished)
+        self.metrics_timer.start()
+
+    @staticmethod
+    def run_batch(job, engine, prompt_list, iterations, journal, completed):
+        # Runs on a pool thread; everything the GUI needs goes through job signals
+        total = iterations * len(prompt_list)
+        done = len(completed)
+        job.emit_status(f"{os.path.basename(prompt_list.filename)}: {prompt_list.summary()}")
+
+        def on_result(prompt, output_path):
+            nonlocal done
+            done += 1
+            job.emit_result((prompt["text"], output_path))
+            job.emit_progress(done, total)
+
+        def on_failure(prompt, unit, message):
+            job.emit_warning(f"'{prompt['text']}' ({unit}): {message}")
+
+        try:
+            engine.run(
+                prompt_list,
+                iterations,
+                on_result=on_result,
+                on_status=job.emit_status,
+                should_stop=job.is_cancelled,
+                journal=journal,
+                completed=completed,
+                on_failure=on_failure,
+            )
+        finally:
+            journal.close()
+
+    def show_image(self, result):
+        prompt_text, output_path = result
+
+        # Display the resulting image
+        self.gallery.add_image(output_path, prompt_text)
+
+    def show_status(self, message):
+        failed = f", {self.failed_count} failed" if self.failed_count else ""
+        self.status_label.setText(f"{message}  [{self.result_cache.stats_text()}{failed}]")
+
+    def unit_failed(self, message):
+        # Failed units are journaled, so Resume will retry them
+        self.failed_count += 1
+        self.failed_units.append(message)
+        self.status_label.setToolTip("Failed units:\n" + "\n".join(self.failed_units))
+
+    def show_progress(self, done, total):
+        self.setWindowTitle(f"Batch DreamStudio Image Generator ({done}/{total})")
+
+    def cancel_generation(self):
+        if self.current_job is not None:
+            self.current_job.cancel()
+            self.cancel_button.setEnabled(False)
+            self.status_label.setText("Cancelling, waiting for in-flight requests...")
+
+    def generation_failed(self, message):
+        self.status_label.setText(f"Error: {message}")
+
+    def generation_cancelled(self):
+        self.status_label.setText("Cancelled.")
+
+    def update_metrics(self):
+        self.metrics_label.setText(metrics.status_text())
+
+    def export_metrics(self):
+        # Prometheus text for scraping/diffing, or a trace for a profiler timeline
+        filename, selected_filter = QtWidgets.QFileDialog.getSaveFileName(
+            self, "Export metrics", "metrics.prom",
+            "Prometheus text (*.prom *.txt);;Chrome trace (*.json)")
+        if not filename:
+            return
+        if filename.endswith(".json") or selected_filter.startswith("Chrome"):
+            metrics.write_trace(filename)
+        else:
+            metrics.write_prometheus(filename)
+        self.status_label.setText(f"Metrics written to {filename}")
+
+    def show_catalog(self):
+        if self.catalog_panel is None:
+            from catalog_panel import CatalogPanel
+            self.catalog_panel = CatalogPanel(self.catalog)
+        self.catalog_panel.show()
+        self.catalog_panel.raise_()
+
+    def generation_finished(self):
+        self.metrics_timer.stop()
+        self.update_metrics()
+        self.current_job = None
+        self.generate_button.setEnabled(True)
+        self.resume_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        if not self.status_label.text().startswith(("Error", "Cancelled")):
+            # Display status message
+            self.show_status("Done!" if not self.failed_count else "Done with failures, use Resume to retry them.")
+
+    def closeEvent(self, event):
+        # Stop handing out new requests; in-flight ones are allowed to finish
+        self.job_runner.shutdown()
+        if "catalog" in self.__dict__:
+            self.catalog.flush()
+        if self.catalog_panel is not None:
+            self.catalog_panel.close()
+        super().closeEvent(event)
 
-        # Get the number of iterations from the spin box
-        iterations = self.iterations_spin_box.value()
-
-        # Get the cfg_scale from the spin box
-        cfg_scale = self.cfg_scale_spin_box.value()
-        
-        # Initialize the numbering counter
-        numbering_counter = 1
-
-        # Iterate through the prompt list the specified number of times
-        for _ in range(iterations):
-            # Make the API request for each prompt
-            for prompt in prompt_list:
-                self.status_label.setText(f"Generating image for prompt '{prompt['text']}'...")
-
-                QtWidgets.QApplication.processEvents()
-
-                response = requests.post(
-                    f"{self.api_host}/v1/generation/{engine_id}/text-to-image",
-                    headers={
-                        "Content-Type": "application/json",
-                        "Accept": "application/json",
-                        "Authorization": f"Bearer {self.api_key}"
-                    },
-                    json={
-                        "text_prompts": [prompt],
-                        "cfg_scale": cfg_scale,
-                        "clip_guidance_preset": "FAST_BLUE",
-                        "samples": 1,
-                        "style_preset": style_preset,
-                        "width": width,
-                        "height": height,
-                    },
-                )
-
-                if response.status_code != 200:
-                    raise Exception("Non-200 response: " + str(response.text))
-
-                data = response.json()
-
-                # Save the resulting image to a file
-                image_data = base64.b64decode(data["artifacts"][0]["base64"])
-                output_path = os.path.join(output_dir, prompt['filename'])
-
-                # Check if the numbering scheme is enabled
-                if self.numbering_checkbox.isChecked():
-                    # Prepend the sequential number to the filename
-                    filename_without_ext, ext = os.path.splitext(prompt['filename'])
-                    output_path = os.path.join(output_dir, f"{numbering_counter:04}_{filename_without_ext}{ext}")
-
-                    # Increment the numbering counter
-                    numbering_counter += 1
-
-                # Check if the file already exists, and append a sequential number if it does
-                i = 1
-                while os.path.exists(output_path):
-                    filename_without_ext, ext = os.path.splitext(prompt['filename'])
-                    output_path = os.path.join(output_dir, f"{filename_without_ext}_{i:03}{ext}")
-                    i += 1
-
-                with open(output_path, "wb") as f:
-                    f.write(image_data)
-
-                # Display the resulting image
-                image_label = QtWidgets.QLabel()
-                image = QtGui.QPixmap()
-                image.loadFromData(image_data)
-                image_label.setPixmap(image)
-                self.image_scroll_area_layout.addWidget(image_label)
-                self.image_scroll_area_widget.adjustSize()
-                QtWidgets.QApplication.processEvents()
-
-                # Scroll to the bottom of the image scroll area
-                self.image_scroll_area.verticalScrollBar().setValue(self.image_scroll_area.verticalScrollBar().maximum())
-
-        # Display status message
-        self.status_label.setText("Done!")
-                
 if __name__ == "__main__":
     app = QtWidgets.QApplication([])
     text_to_image_app = TextToImageApp()
@@ -0,0 +1,528 @@
+#!/usr/bin/env python
+# Concurrent text-to-image engine used by the batch DreamStudio generator
+# Keeps a bounded number of requests in flight and writes each image as soon
+# as its response arrives. Has no Qt dependency, so it also runs headless:
+#
+#   python -m batch_engine prompts.txt --output-dir out --concurrency 8
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import ExitStack
+
+from api_client import get_client
+from asset_writer import AssetWriter
+from catalog import Catalog
+from generation_settings import (
+    DEFAULT_ENGINE_ID,
+    DEFAULT_STYLE_PRESET,
+    ENGINE_IDS,
+    STYLE_PRESETS,
+    make_settings,
+    read_api_key,
+)
+from job_journal import JobJournal, completed_units, load_journal, unit_id
+from metrics import metrics
+from pipeline_limits import DEFAULT_MAX_INFLIGHT_BYTES, ByteBudget, PipelineLimits
+from postprocess import FORMATS, PostProcessError, PostProcessOptions, PostProcessor, check_options
+from prompt_source import PromptSource
+from providers import MAX_SAMPLES, StabilityProvider, load_providers
+from rate_limiter import RetryBudget, get_rate_limiter
+from result_cache import ResultCache, make_key
+
+
+def is_seeded(prompt):
+    # Seed 0 asks the API for a random seed, like leaving it out
+    return bool(prompt.get("seed"))
+
+
+def read_prompt_list(filename, width, height):
+    # The prompts are streamed from the file each time the list is iterated
+    return PromptSource(filename, width, height)
+
+
+def engine_from_settings(settings, api_host, api_key, output_dir, **kwargs):
+    return BatchEngine(
+        api_host,
+        api_key,
+        settings["engine_id"],
+        settings["style_preset"],
+        settings["cfg_scale"],
+        settings["width"],
+        settings["height"],
+        output_dir,
+        numbering=settings["numbering"],
+        **kwargs
+    )
+
+
+class BatchEngine:
+    def __init__(self, api_host, api_key, engine_id, style_preset, cfg_scale,
+                 width, height, output_dir, numbering=True, concurrency=4, client=None,
+                 cache=None, force_regenerate=False, limiter=None, samples_per_request=1, provider=None,
+                 fsync=False, postprocess=None, catalog=None, limits=None):
+        self.api_host = api_host
+        self.api_key = api_key
+        self.engine_id = engine_id
+        self.style_preset = style_preset
+        self.cfg_scale = cfg_scale
+        self.width = width
+        self.height = height
+        self.output_dir = output_dir
+        self.numbering = numbering
+        self.concurrency = max(1, concurrency)
+        self.client = client if client is not None else get_client(self.concurrency)
+        self.cache = cache
+        self.force_regenerate = force_regenerate
+        self.limiter = limiter if limiter is not None else get_rate_limiter()
+
+        # A single Stability key unless a provider (or pool of them) is given
+        if provider is None:
+            provider = StabilityProvider(api_key, api_host, limiter=self.limiter, client=self.client)
+        self.provider = provider
+        self.samples_per_request = min(max(1, samples_per_request), provider.capabilities.max_samples)
+        self.fsync = fsync
+        self.postprocess = postprocess
+        self.catalog = catalog
+        self.limits = limits if limits is not None else PipelineLimits()
+        self.failed = 0
+
+        # Set per run(); shared by every request the run makes
+        self._retry_budget = None
+        self._should_stop = None
+        self._writer = None
+
+    def build_payload(self, prompt, samples=1):
+        # Per-prompt overrides from CSV/JSONL prompt files (and sweeps, which
+        # also vary the engine and style) win over the batch settings
+        text_prompts = [{"text": prompt["text"], "weight": prompt.get("weight", 1.0)}]
+        if prompt.get("negative_prompt"):
+            text_prompts.append({"text": prompt["negative_prompt"], "weight": -1.0})
+        payload = {
+            "text_prompts": text_prompts,
+            "cfg_scale": prompt.get("cfg_scale", self.cfg_scale),
+            "clip_guidance_preset": "FAST_BLUE",
+            "samples": samples,
+            "style_preset": prompt.get("style_preset", self.style_preset),
+            "width": prompt.get("width", self.width),
+            "height": prompt.get("height", self.height),
+        }
+        if "seed" in prompt:
+            payload["seed"] = prompt["seed"]
+        return payload
+
+    def new_temp_path(self):
+        # Images are decoded into a temp file in the output dir and renamed once named
+        fd, tmp_path = tempfile.mkstemp(dir=self.output_dir, suffix=".part")
+        os.close(fd)
+        return tmp_path
+
+    def request_images(self, engine_id, payload, tmp_paths):
+        # One request for len(tmp_paths) samples; the response is streamed and
+        # artifact i is written straight into tmp_paths[i]
+        files = {}
+
+        def open_artifact(index):
+            if index >= len(tmp_paths):
+                return None
+            # A retried attempt starts the file over
+            if index in files:
+                files[index].close()
+            f = files[index] = open(tmp_paths[index], "wb")
+            return f
+
+        try:
+            artifacts = self.provider.generate(
+                engine_id, payload, open_artifact, budget=self._retry_budget, should_stop=self._should_stop)
+        finally:
+            for f in files.values():
+                f.close()
+        if len(artifacts) < len(tmp_paths):
+            raise Exception(f"Expected {len(tmp_paths)} artifacts, got {len(artifacts)}")
+        return artifacts
+
+    def fetch_images(self, prompt, group, tmp_paths):
+        # Serve what we can from the result cache unless a fresh image is forced,
+        # then request every missing sample of the group in a single call.
+        # Returns each image's seed where it is known.
+        if is_seeded(prompt) and len(group) > 1:
+            # Every unit of a seeded prompt is the same image (and has the same
+            # key): get it once and copy it, rather than asking for N samples
+            # that would come back as N different images under one key
+            seeds = self.fetch_images(prompt, group[:1], tmp_paths[:1])
+            for tmp_path in tmp_paths[1:]:
+                shutil.copyfile(tmp_paths[0], tmp_path)
+            return seeds * len(tmp_paths)
+
+        seeds = [prompt.get("seed")] * len(tmp_paths)
+        missing = []
+        for (iteration, number, unit), tmp_path in zip(group, tmp_paths):
+            key = self.request_key(prompt, iteration)
+            if self.cache is not None and not self.force_regenerate:
+                with metrics.span("cache_lookup"):
+                    hit = self.cache.copy_to(key, tmp_path)
+                if hit:
+                    continue
+            if self.catalog is not None and is_seeded(prompt) and not self.force_regenerate:
+                # A seeded request always produces the same image, so any earlier
+                # output of the same request can stand in for it
+                existing = self.catalog.find_request(key, os.path.splitext(self.output_filename(prompt))[1])
+                if existing is not None:
+                    shutil.copyfile(existing, tmp_path)
+                    metrics.incr("catalog_hits")
+                    continue
+            missing.append((key, tmp_path))
+
+        if not missing:
+            return seeds
+        artifacts = self.request_images(
+            prompt.get("engine_id", self.engine_id), self.build_payload(prompt, len(missing)), [tmp_path for _, tmp_path in missing])
+        for (key, tmp_path), artifact in zip(missing, artifacts):
+            seeds[tmp_paths.index(tmp_path)] = artifact.get("seed", prompt.get("seed"))
+        if self.cache is not None:
+            with metrics.span("cache_store"):
+                for key, tmp_path in missing:
+                    self.cache.put_file(key, tmp_path)
+        return seeds
+
+    def request_key(self, prompt, iteration):
+        return make_key(prompt.get("engine_id", self.engine_id), self.build_payload(prompt), variant=iteration)
+
+    def output_filename(self, prompt):
+        if self.postprocess is not None:
+            return self.postprocess.output_filename(prompt["filename"])
+        return prompt["filename"]
+
+    def image_metadata(self, prompt, seed):
+        # Generation parameters embedded into the image by post-processing
+        payload = self.build_payload(prompt)
+        return {
+            "prompt": prompt["text"],
+            "negative_prompt": prompt.get("negative_prompt"),
+            "engine_id": prompt.get("engine_id", self.engine_id),
+            "style_preset": payload["style_preset"],
+            "cfg_scale": payload["cfg_scale"],
+            "seed": seed,
+            "width": payload["width"],
+            "height": payload["height"],
+        }
+
+    def _generate_group(self, prompt, group, journal):
+        # Returns (writer Future, seed) per unit; naming and renaming the
+        # finished temp files happens on the writer thread, not this request thread
+        tmp_paths = [self.new_temp_path() for _ in group]
+        start = time.perf_counter()
+        try:
+            seeds = self.fetch_images(prompt, group, tmp_paths)
+        except Exception as e:
+            for tmp_path in tmp_paths:
+                os.remove(tmp_path)
+            if journal is not None:
+                for _, _, unit in group:
+                    journal.record(unit, "failed", error=str(e))
+            raise
+
+        seconds = (time.perf_counter() - start) / len(group)
+        filename = self.output_filename(prompt)
+        return [(self._writer.submit(tmp_path, filename, number), seed, seconds)
+                for (iteration, number, unit), tmp_path, seed in zip(group, tmp_paths, seeds)]
+
+    def groups(self, prompt_list, iterations, completed=()):
+        # Yields (prompt, [(iteration, number, unit), ...]) in the order the
+        # prompt file is iterated, skipping units a previous (journaled) run
+        # already finished. With samples_per_request > 1, consecutive
+        # iterations of the same prompt are grouped into one request. All
+        # iterations of a seeded prompt form one group with the first block,
+        # since they all come from a single request.
+        for first in range(0, iterations, self.samples_per_request):
+            block = range(first, min(first + self.samples_per_request, iterations))
+            for index, prompt in enumerate(prompt_list):
+                if is_seeded(prompt):
+                    if first:
+                        continue
+                    prompt_block = range(iterations)
+                else:
+                    prompt_block = block
+                group = []
+                for iteration in prompt_block:
+                    unit = unit_id(iteration, index)
+                    if unit in completed:
+                        continue
+                    number = None
+                    if self.numbering:
+                        number = iteration * len(prompt_list) + index + 1
+                    group.append((iteration, number, unit))
+                if group:
+                    yield prompt, group
+
+    def run(self, prompt_list, iterations, on_result=None, on_status=None, should_stop=None,
+            journal=None, completed=(), on_failure=None):
+        # Callbacks are invoked from the thread calling run(), never from a worker.
+        # A unit that still fails after its retries is reported through
+        # on_failure and journaled; the rest of the batch carries on.
+        self._retry_budget = RetryBudget()
+        self._should_stop = should_stop
+        self.failed = 0
+        requests = {}
+        writes = {}
+        processing = {}
+        groups = self.groups(prompt_list, iterations, completed)
+        exhausted = False
+        # The next group, held back while the stages after the requests are full
+        waiting = None
+        budget = ByteBudget(self.limits.max_inflight_bytes)
+
+        with ExitStack() as stack:
+            # Exits in reverse: requests finish, then post-processing, then writes
+            self._writer = stack.enter_context(
+                AssetWriter(self.output_dir, fsync=self.fsync, queue_size=self.limits.write_queue))
+            postprocessor = None
+            if self.postprocess is not None and self.postprocess.enabled:
+                postprocessor = stack.enter_context(PostProcessor(self.postprocess))
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=self.concurrency))
+
+            while True:
+                # Top up the pool so that `concurrency` requests stay in flight,
+                # as long as post-processing keeps up and the byte budget allows
+                while (not exhausted and len(requests) < self.concurrency
+                       and len(processing) < self.limits.max_processing):
+                    if should_stop is not None and should_stop():
+                        exhausted = True
+                        break
+                    if waiting is None:
+                        try:
+                            waiting = next(groups)
+                        except StopIteration:
+                            exhausted = True
+                            break
+                    prompt, group = waiting
+                    if not budget.fits(len(group)):
+                        metrics.incr("backpressure_waits")
+                        break
+                    waiting = None
+                    if on_status is not None:
+                        if len(group) == 1:
+                            on_status(f"Generating image for prompt '{prompt['text']}'...")
+                        else:
+                            on_status(f"Generating {len(group)} images for prompt '{prompt['text']}'...")
+                    if journal is not None:
+                        for _, _, unit in group:
+                            journal.record(unit, "pending")
+                    future = executor.submit(self._generate_group, prompt, group, journal)
+                    requests[future] = (prompt, group, [budget.reserve() for _ in group])
+
+                metrics.set_gauge("inflight_requests", len(requests))
+                metrics.set_gauge("pending_writes", len(writes))
+                metrics.set_gauge("pending_processing", len(processing))
+                metrics.set_gauge("inflight_bytes", budget.in_use)
+                if not requests and not writes and not processing:
+                    break
+
+                done, _ = wait(list(requests) + list(writes) + list(processing), return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in requests:
+                        prompt, group, reserved = requests.pop(future)
+                        try:
+                            unit_writes = future.result()
+                        except Exception as e:
+                            budget.release(sum(reserved))
+                            self.failed += len(group)
+                            if on_failure is not None:
+                                for _, _, unit in group:
+                                    on_failure(prompt, unit, str(e))
+                            continue
+                        for (iteration, _, unit), (write, seed, seconds), amount in zip(group, unit_writes, reserved):
+                            writes[write] = (prompt, unit, (iteration, seed, seconds), amount)
+                        continue
+
+                    if future in processing:
+                        prompt, output_path, details, amount = processing.pop(future)
+                        budget.release(amount)
+                        try:
+                            future.result()
+                        except Exception as e:
+                            # The image itself is done; it just stays unprocessed
+                            metrics.incr("postprocess_failed")
+                            if on_status is not None:
+                                on_status(f"Post-processing {os.path.basename(output_path)} failed: {e}")
+                        self._image_done(prompt, output_path, details, on_result)
+                        continue
+
+                    prompt, unit, details, amount = writes.pop(future)
+                    try:
+                        output_path = future.result()
+                    except Exception as e:
+                        budget.release(amount)
+                        self.failed += 1
+                        if journal is not None:
+                            journal.record(unit, "failed", error=str(e))
+                        if on_failure is not None:
+                            on_failure(prompt, unit, str(e))
+                        continue
+                    if journal is not None:
+                        journal.record(unit, "done", path=output_path)
+                    metrics.incr("images")
+                    try:
+                        amount = budget.measured(amount, os.path.getsize(output_path))
+                    except OSError:
+                        pass
+                    if postprocessor is not None:
+                        iteration, seed, seconds = details
+                        processing[postprocessor.submit(output_path, self.image_metadata(prompt, seed))] = \
+                            (prompt, output_path, details, amount)
+                    else:
+                        budget.release(amount)
+                        self._image_done(prompt, output_path, details, on_result)
+
+    def _image_done(self, prompt, output_path, details, on_result):
+        iteration, seed, seconds = details
+        if self.catalog is not None:
+            self.catalog.add(output_path, self.image_metadata(prompt, seed),
+                             request_key=self.request_key(prompt, iteration), seconds=seconds)
+        if on_result is not None:
+            on_result(prompt, output_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch DreamStudio image generator (headless)")
+    parser.add_argument("prompt_file", nargs="?",
+                        help="text file with one prompt per line, or a CSV/JSONL file with per-prompt overrides")
+    parser.add_argument("--engine", default=DEFAULT_ENGINE_ID, choices=ENGINE_IDS)
+    parser.add_argument("--style", default=DEFAULT_STYLE_PRESET, choices=STYLE_PRESETS)
+    parser.add_argument("--cfg-scale", type=int, default=7)
+    parser.add_argument("--iterations", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--samples-per-request", type=int, default=1,
+                        help=f"batch up to this many iterations of a prompt into one request (max {MAX_SAMPLES})")
+    parser.add_argument("--output-dir", default=os.getcwd())
+    parser.add_argument("--no-numbering", action="store_true", help="don't prepend a sequence number to filenames")
+    parser.add_argument("--no-cache", action="store_true", help="don't read or write the result cache")
+    parser.add_argument("--no-catalog", action="store_true", help="don't record images in the image catalog")
+    parser.add_argument("--force-regenerate", action="store_true", help="ignore cached results")
+    parser.add_argument("--format", default="png", choices=FORMATS, help="transcode images to this format")
+    parser.add_argument("--quality", type=int, default=90, help="quality for --format webp/jpeg/avif")
+    parser.add_argument("--preview-size", type=int, help="also write previews this many pixels wide to previews/")
+    parser.add_argument("--embed-metadata", action="store_true",
+                        help="embed the prompt and generation parameters in each image")
+    parser.add_argument("--fsync", action="store_true", help="fsync images (in batches) before reporting them done")
+    parser.add_argument("--max-inflight-mb", type=int, default=DEFAULT_MAX_INFLIGHT_BYTES // (1024 * 1024),
+                        help="start no new request while this many MiB of images are still in the pipeline")
+    parser.add_argument("--resume", action="store_true", help="continue the last journaled run in --output-dir")
+    parser.add_argument("--api-key-file", default="api_key.txt")
+    parser.add_argument("--api-host", default=os.getenv("API_HOST", "https://api.stability.ai"))
+    parser.add_argument("--providers", help="JSON file of providers/API keys to spread the batch over")
+    parser.add_argument("--metrics-file", help="write Prometheus text metrics here when the run ends")
+    parser.add_argument("--trace-file", help="stream a Chrome trace-event timeline of the run here")
+    args = parser.parse_args(argv)
+
+    if args.trace_file:
+        metrics.start_trace(args.trace_file)
+
+    # Check everything before touching the journal: a new "start" record
+    # hides the previous run from --resume
+    output_dir = args.output_dir
+    completed = set()
+    if args.resume:
+        journal_state = load_journal(output_dir)
+        if journal_state is None:
+            parser.error(f"no batch journal found in {output_dir}")
+        settings, units = journal_state
+        completed = completed_units(units)
+    else:
+        if args.prompt_file is None:
+            parser.error("a prompt file is required unless --resume is given")
+        settings = make_settings(
+            args.prompt_file, args.engine, args.style, args.cfg_scale, args.iterations,
+            numbering=not args.no_numbering)
+    if not os.path.isfile(settings["filename"]):
+        parser.error(f"prompt file not found: {settings['filename']}")
+
+    provider = None
+    api_key = None
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        if args.providers:
+            provider = load_providers(args.providers, client=get_client(args.concurrency))
+        else:
+            api_key = read_api_key(args.api_key_file)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    postprocess = PostProcessOptions(args.format, args.quality, args.preview_size, args.embed_metadata)
+    if postprocess.enabled:
+        try:
+            check_options(postprocess)
+        except PostProcessError as e:
+            parser.error(str(e))
+
+    engine = engine_from_settings(
+        settings,
+        args.api_host,
+        api_key,
+        output_dir,
+        provider=provider,
+        concurrency=args.concurrency,
+        samples_per_request=args.samples_per_request,
+        cache=None if args.no_cache else ResultCache(),
+        force_regenerate=args.force_regenerate,
+        fsync=args.fsync,
+        postprocess=postprocess,
+        catalog=None if args.no_catalog else Catalog(),
+        limits=PipelineLimits(max_inflight_bytes=args.max_inflight_mb * 1024 * 1024),
+    )
+
+    journal = JobJournal(output_dir)
+    if args.resume:
+        journal.resume()
+    else:
+        journal.start(settings)
+    prompt_list = read_prompt_list(settings["filename"], settings["width"], settings["height"])
+    total = settings["iterations"] * len(prompt_list)
+    print(f"{settings['filename']}: {prompt_list.summary()}", flush=True)
+    for line_no, message in prompt_list.errors:
+        print(f"  line {line_no}: {message}", file=sys.stderr)
+    done = len(completed)
+
+    def on_result(prompt, output_path):
+        nonlocal done
+        done += 1
+        print(f"[{done}/{total}] {output_path}", flush=True)
+
+    def on_failure(prompt, unit, message):
+        print(f"Failed '{prompt['text']}' ({unit}): {message}", file=sys.stderr, flush=True)
+
+    try:
+        engine.run(
+            prompt_list,
+            settings["iterations"],
+            on_result=on_result,
+            should_stop=None,
+            journal=journal,
+            completed=completed,
+            on_failure=on_failure,
+        )
+    except KeyboardInterrupt:
+        print("Interrupted; continue with --resume", file=sys.stderr)
+        return 130
+    finally:
+        journal.close()
+        if engine.catalog is not None:
+            engine.catalog.flush()
+        metrics.stop_trace()
+        if args.metrics_file:
+            metrics.write_prometheus(args.metrics_file)
+
+    summary = f"Done: {done}/{total} images, {engine.failed} failed"
+    if engine.cache is not None:
+        summary += f" ({engine.cache.stats_text()})"
+    print(summary)
+    print(metrics.status_text())
+    return 1 if engine.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# End-to-end throughput benchmark for the batch generation path
+# Drives BatchEngine against an in-process mock API (see mock_server.py) and
+# reports images/sec, request latency percentiles, peak RSS and per-stage
+# timings. Thresholds turn it into a regression check:
+#
+#   python benchmark.py --images 200 --concurrency 16 --latency 0.3
+#   python benchmark.py --min-images-per-sec 20 --max-p95 1.0
+
+import argparse
+import json
+import math
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from api_client import ApiClient
+from batch_engine import DEFAULT_ENGINE_ID, DEFAULT_STYLE_PRESET, BatchEngine, read_prompt_list
+from metrics import metrics
+from mock_server import MockApiServer, add_config_arguments, config_from_args
+from rate_limiter import RateLimiter
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def run_benchmark(images, prompts, concurrency, samples_per_request, mock_config, api_host=None):
+    server = None
+    if api_host is None:
+        server = MockApiServer(config=mock_config).start()
+        api_host = server.url
+
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            prompt_file = os.path.join(work_dir, "prompts.txt")
+            with open(prompt_file, "w") as f:
+                for i in range(prompts):
+                    f.write(f"benchmark prompt {i}\n")
+            output_dir = os.path.join(work_dir, "out")
+            os.makedirs(output_dir)
+
+            # No cache and an effectively unlimited rate limit: measure the pipeline, not the throttles
+            engine = BatchEngine(
+                api_host, "mock", DEFAULT_ENGINE_ID, DEFAULT_STYLE_PRESET, 7, 512, 512, output_dir,
+                concurrency=concurrency,
+                client=ApiClient(pool_size=concurrency),
+                limiter=RateLimiter(rate=1e6, burst=1e6, initial_concurrency=concurrency,
+                                    max_concurrency=concurrency),
+                samples_per_request=samples_per_request,
+            )
+            metrics.reset()
+            prompt_list = read_prompt_list(prompt_file, 512, 512)
+            iterations = math.ceil(images / prompts)
+            produced = 0
+
+            def on_result(prompt, output_path):
+                nonlocal produced
+                produced += 1
+
+            start = time.perf_counter()
+            engine.run(prompt_list, iterations, on_result=on_result)
+            elapsed = time.perf_counter() - start
+    finally:
+        if server is not None:
+            stats = server.snapshot()
+            server.stop()
+        else:
+            stats = {}
+
+    stages = metrics.stage_summary()
+    latency = stages.get("request", {})
+    return {
+        "images": produced,
+        "failed": engine.failed,
+        "elapsed": elapsed,
+        "images_per_sec": produced / elapsed if elapsed else 0.0,
+        "latency_p50": latency.get("p50", 0.0),
+        "latency_p95": latency.get("p95", 0.0),
+        "latency_p99": latency.get("p99", 0.0),
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": stages,
+        "counters": dict(metrics.counters),
+        "server": stats,
+    }
+
+
+def format_report(report):
+    lines = [
+        f"images:        {report['images']} ({report['failed']} failed) in {report['elapsed']:.2f}s",
+        f"throughput:    {report['images_per_sec']:.2f} images/sec",
+        f"latency:       p50 {report['latency_p50'] * 1000:.0f}ms  "
+        f"p95 {report['latency_p95'] * 1000:.0f}ms  p99 {report['latency_p99'] * 1000:.0f}ms",
+        f"peak RSS:      {report['peak_rss_mb']:.1f} MiB",
+        "stages:",
+    ]
+    for stage, stats in sorted(report["stages"].items()):
+        lines.append(f"  {stage:<14} n={stats['count']:<6} mean {stats['mean'] * 1000:8.1f}ms  "
+                     f"p95 {stats['p95'] * 1000:8.1f}ms  total {stats['total']:.2f}s")
+    lines.append(f"counters:      {report['counters']}")
+    if report["server"]:
+        lines.append(f"server:        {report['server']}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark batch generation against a mock API")
+    parser.add_argument("--images", type=int, default=100)
+    parser.add_argument("--prompts", type=int, default=10, help="distinct prompts in the generated prompt file")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--samples-per-request", type=int, default=1)
+    parser.add_argument("--api-host", help="benchmark an already running (mock) server instead")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--min-images-per-sec", type=float, help="exit non-zero below this throughput")
+    parser.add_argument("--max-p95", type=float, help="exit non-zero above this p95 request latency (seconds)")
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(
+        args.images, args.prompts, args.concurrency, args.samples_per_request,
+        config_from_args(args), api_host=args.api_host)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+
+    failures = []
+    if args.min_images_per_sec is not None and report["images_per_sec"] < args.min_images_per_sec:
+        failures.append(f"throughput {report['images_per_sec']:.2f} < {args.min_images_per_sec}")
+    if args.max_p95 is not None and report["latency_p95"] > args.max_p95:
+        failures.append(f"p95 latency {report['latency_p95']:.3f}s > {args.max_p95}s")
+    if report["failed"]:
+        failures.append(f"{report['failed']} images failed")
+    for failure in failures:
+        print(f"REGRESSION: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
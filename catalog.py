@@ -0,0 +1,300 @@
+# Persistent catalog of every generated image
+# A SQLite database with an FTS5 index over the prompts, written by all the
+# generators, so past results can be found by prompt, engine or style instead
+# of by grepping filenames. Each entry also keeps the request key and a
+# content hash, which lets a repeated seeded request reuse an existing image
+# and lets files with identical bytes share one copy on disk (dedupe).
+# Inserts are hashed and committed in batches on a background thread.
+#
+#   python catalog.py search "lighthouse dusk"
+#   python catalog.py stats
+#   python catalog.py dedupe --dry-run
+
+import argparse
+import hashlib
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+
+from metrics import metrics
+
+DEFAULT_CATALOG_PATH = os.getenv(
+    "IMAGE_CATALOG", os.path.join(os.path.expanduser("~"), ".local", "share", "dsimg", "catalog.sqlite"))
+
+# Pending entries committed per transaction, and the longest an entry waits
+COMMIT_BATCH = 200
+COMMIT_INTERVAL = 0.5
+# Images waiting for the writer before add() blocks, so a slow disk holds up
+# the batch instead of the queue growing
+MAX_PENDING = 10 * COMMIT_BATCH
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    prompt TEXT NOT NULL,
+    negative_prompt TEXT,
+    engine_id TEXT,
+    style_preset TEXT,
+    cfg_scale REAL,
+    width INTEGER,
+    height INTEGER,
+    seed INTEGER,
+    request_key TEXT,
+    content_hash TEXT,
+    size_bytes INTEGER,
+    generation_seconds REAL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_request_key ON images(request_key);
+CREATE INDEX IF NOT EXISTS images_content_hash ON images(content_hash);
+CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5(
+    prompt, negative_prompt, engine_id, style_preset, content='images', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS images_ai AFTER INSERT ON images BEGIN
+    INSERT INTO images_fts(rowid, prompt, negative_prompt, engine_id, style_preset)
+    VALUES (new.id, new.prompt, new.negative_prompt, new.engine_id, new.style_preset);
+END;
+CREATE TRIGGER IF NOT EXISTS images_ad AFTER DELETE ON images BEGIN
+    INSERT INTO images_fts(images_fts, rowid, prompt, negative_prompt, engine_id, style_preset)
+    VALUES ('delete', old.id, old.prompt, old.negative_prompt, old.engine_id, old.style_preset);
+END;
+CREATE TRIGGER IF NOT EXISTS images_au AFTER UPDATE ON images BEGIN
+    INSERT INTO images_fts(images_fts, rowid, prompt, negative_prompt, engine_id, style_preset)
+    VALUES ('delete', old.id, old.prompt, old.negative_prompt, old.engine_id, old.style_preset);
+    INSERT INTO images_fts(rowid, prompt, negative_prompt, engine_id, style_preset)
+    VALUES (new.id, new.prompt, new.negative_prompt, new.engine_id, new.style_preset);
+END;
+"""
+
+COLUMNS = ("id", "path", "prompt", "negative_prompt", "engine_id", "style_preset", "cfg_scale",
+           "width", "height", "seed", "request_key", "content_hash", "size_bytes",
+           "generation_seconds", "created")
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def match_expression(text):
+    # Every word of the search box must match, as a prefix, anywhere in the
+    # indexed columns; quoting keeps FTS5 syntax characters literal
+    words = text.split()
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+
+
+def _connect(path):
+    connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class Catalog:
+    def __init__(self, path=DEFAULT_CATALOG_PATH):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with _connect(path) as connection:
+            connection.executescript(SCHEMA)
+        connection.close()
+
+        # Readers get a connection per thread; the writer thread has its own
+        self._local = threading.local()
+        self._queue = queue.Queue(MAX_PENDING)
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def _reader(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = _connect(self.path)
+        return connection
+
+    def add(self, path, metadata, request_key=None, seconds=None):
+        # metadata: prompt, negative_prompt, engine_id, style_preset,
+        # cfg_scale, width, height, seed (missing keys are stored as NULL)
+        self._ensure_writer()
+        self._queue.put((os.path.abspath(path), dict(metadata), request_key, seconds, time.time()))
+
+    def _ensure_writer(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="catalog-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        connection = _connect(self.path)
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + COMMIT_INTERVAL
+            while len(batch) < COMMIT_BATCH:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            with metrics.span("catalog", images=len(batch)):
+                self._insert(connection, batch)
+        connection.close()
+
+    def _insert(self, connection, batch):
+        rows = []
+        for path, metadata, request_key, seconds, created in batch:
+            try:
+                content_hash = file_hash(path)
+                size = os.path.getsize(path)
+            except OSError:
+                # The image is gone again (e.g. cancelled and cleaned up)
+                continue
+            rows.append((
+                path, metadata.get("prompt", ""), metadata.get("negative_prompt"), metadata.get("engine_id"),
+                metadata.get("style_preset"), metadata.get("cfg_scale"), metadata.get("width"),
+                metadata.get("height"), metadata.get("seed"), request_key, content_hash, size, seconds, created,
+            ))
+        with connection:
+            # A path that is written again (e.g. regenerated in place) updates its
+            # entry; an upsert, unlike REPLACE, fires the trigger that keeps FTS in sync
+            connection.executemany(
+                "INSERT INTO images (path, prompt, negative_prompt, engine_id, style_preset, cfg_scale, "
+                "width, height, seed, request_key, content_hash, size_bytes, generation_seconds, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET " + ", ".join(
+                    f"{column} = excluded.{column}" for column in COLUMNS[2:]), rows)
+
+    def flush(self):
+        # Waits until everything added so far is committed
+        with self._thread_lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join()
+
+    close = flush
+
+    def search(self, text="", limit=200, offset=0):
+        # Newest first (by id, so both queries walk an index backwards and stop
+        # at limit); with text, only images whose prompt, negative prompt,
+        # engine or style contain every word (as a prefix)
+        columns = ", ".join("images." + column for column in COLUMNS)
+        expression = match_expression(text)
+        if expression:
+            sql = (f"SELECT {columns} FROM images_fts JOIN images ON images.id = images_fts.rowid "
+                   "WHERE images_fts MATCH ? ORDER BY images_fts.rowid DESC LIMIT ? OFFSET ?")
+            params = (expression, limit, offset)
+        else:
+            sql = f"SELECT {columns} FROM images ORDER BY id DESC LIMIT ? OFFSET ?"
+            params = (limit, offset)
+        rows = self._reader().execute(sql, params).fetchall()
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def find_request(self, request_key, extension=None):
+        # Path of an existing image generated from the same request, or None
+        rows = self._reader().execute(
+            "SELECT path FROM images WHERE request_key = ? ORDER BY created DESC", (request_key,)).fetchall()
+        for (path,) in rows:
+            if (extension is None or path.endswith(extension)) and os.path.exists(path):
+                return path
+        return None
+
+    def find_content(self, content_hash):
+        # Existing paths holding exactly these bytes
+        rows = self._reader().execute(
+            "SELECT path FROM images WHERE content_hash = ? ORDER BY created", (content_hash,)).fetchall()
+        return [path for (path,) in rows if os.path.exists(path)]
+
+    def link_duplicates(self, dry_run=False):
+        # Replaces every file whose bytes an older cataloged file already holds
+        # with a hardlink to that file; returns (files linked, bytes saved).
+        # Files that changed since they were cataloged, or live on another
+        # filesystem than their original, are left alone.
+        hashes = self._reader().execute(
+            "SELECT content_hash FROM images WHERE content_hash IS NOT NULL "
+            "GROUP BY content_hash HAVING COUNT(*) > 1").fetchall()
+        linked = saved = 0
+        for (content_hash,) in hashes:
+            paths = [path for path in self.find_content(content_hash) if file_hash(path) == content_hash]
+            if len(paths) < 2:
+                continue
+            original = paths[0]
+            for path in paths[1:]:
+                if os.path.samefile(original, path):
+                    continue
+                size = os.path.getsize(path)
+                if not dry_run:
+                    tmp_path = path + ".link"
+                    try:
+                        os.link(original, tmp_path)
+                        os.replace(tmp_path, path)
+                    except OSError:
+                        if os.path.lexists(tmp_path):
+                            os.remove(tmp_path)
+                        continue
+                linked += 1
+                saved += size
+        return linked, saved
+
+    def average_seconds(self, engine_id, recent=200):
+        # Mean generation time of the engine's most recent images, or None
+        (seconds,) = self._reader().execute(
+            "SELECT AVG(generation_seconds) FROM (SELECT generation_seconds FROM images "
+            "WHERE engine_id = ? AND generation_seconds IS NOT NULL ORDER BY id DESC LIMIT ?)",
+            (engine_id, recent)).fetchone()
+        return seconds
+
+    def stats(self):
+        count, total_bytes, duplicates = self._reader().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size_bytes), 0), "
+            "COUNT(*) - COUNT(DISTINCT content_hash) FROM images").fetchone()
+        return {"images": count, "bytes": total_bytes, "duplicates": duplicates}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Search the catalog of generated images")
+    parser.add_argument("--catalog", default=DEFAULT_CATALOG_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+    search = commands.add_parser("search", help="list images whose prompt matches every word")
+    search.add_argument("words", nargs="*")
+    search.add_argument("--limit", type=int, default=50)
+    commands.add_parser("stats", help="show the number of images and duplicates")
+    dedupe = commands.add_parser("dedupe", help="replace duplicate images with hardlinks to the oldest copy")
+    dedupe.add_argument("--dry-run", action="store_true", help="only report what would be linked")
+    args = parser.parse_args(argv)
+
+    catalog = Catalog(args.catalog)
+    if args.command == "stats":
+        stats = catalog.stats()
+        print(f"{stats['images']} images, {stats['bytes'] / (1024 * 1024):.1f} MiB, "
+              f"{stats['duplicates']} duplicates")
+        return 0
+    if args.command == "dedupe":
+        linked, saved = catalog.link_duplicates(dry_run=args.dry_run)
+        verb = "Would link" if args.dry_run else "Linked"
+        print(f"{verb} {linked} duplicates, {saved / (1024 * 1024):.1f} MiB saved")
+        return 0
+
+    start = time.perf_counter()
+    rows = catalog.search(" ".join(args.words), limit=args.limit)
+    elapsed = time.perf_counter() - start
+    for row in rows:
+        print(f"{row['path']}\t{row['engine_id']}\t{row['seed']}\t{row['prompt']}")
+    print(f"{len(rows)} results in {elapsed * 1000:.1f}ms", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
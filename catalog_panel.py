@@ -0,0 +1,120 @@
+# Search/browse panel over the image catalog
+# Queries run as the user types (debounced) and fetch one page of results at
+# a time; further pages are only queried when the view scrolls to them, and
+# thumbnails are decoded only for the rows being painted.
+
+import time
+
+from qtpy import QtCore, QtWidgets
+
+from thumbnail_gallery import DEFAULT_CACHE_BYTES, GalleryModel, ThumbnailCache, ThumbnailGallery
+
+PAGE_SIZE = 200
+SEARCH_DELAY_MS = 150
+
+
+class CatalogModel(QtCore.QAbstractListModel):
+    PathRole = GalleryModel.PathRole
+
+    def __init__(self, catalog, thumbnail_cache, parent=None):
+        super().__init__(parent)
+        self.catalog = catalog
+        self.thumbnail_cache = thumbnail_cache
+        self.query = ""
+        self.last_query_seconds = 0.0
+        self._rows = []
+        self._exhausted = True
+
+    def search(self, text):
+        self.beginResetModel()
+        self.query = text
+        self._rows = []
+        self._exhausted = False
+        self.endResetModel()
+        self.fetchMore()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._rows)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self._rows[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            return row["prompt"]
+        if role == QtCore.Qt.ToolTipRole:
+            details = [row["prompt"], row["path"]]
+            for name in ("negative_prompt", "engine_id", "style_preset", "cfg_scale", "seed"):
+                if row[name] is not None:
+                    details.append(f"{name}: {row[name]}")
+            if row["width"]:
+                details.append(f"size: {row['width']}x{row['height']}")
+            if row["generation_seconds"] is not None:
+                details.append(f"generated in {row['generation_seconds']:.1f}s")
+            return "\n".join(details)
+        if role == QtCore.Qt.DecorationRole:
+            return self.thumbnail_cache.get(row["path"])
+        if role == self.PathRole:
+            return row["path"]
+        return None
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        return not parent.isValid() and not self._exhausted
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        if parent.isValid() or self._exhausted:
+            return
+        start = time.perf_counter()
+        rows = self.catalog.search(self.query, limit=PAGE_SIZE, offset=len(self._rows))
+        self.last_query_seconds = time.perf_counter() - start
+        if len(rows) < PAGE_SIZE:
+            self._exhausted = True
+        if not rows:
+            return
+        first = len(self._rows)
+        self.beginInsertRows(QtCore.QModelIndex(), first, first + len(rows) - 1)
+        self._rows.extend(rows)
+        self.endInsertRows()
+
+
+class CatalogPanel(QtWidgets.QWidget):
+    def __init__(self, catalog, parent=None, cache_bytes=DEFAULT_CACHE_BYTES):
+        super().__init__(parent)
+        self.setWindowTitle("Image catalog")
+
+        self.search_input = QtWidgets.QLineEdit()
+        self.search_input.setPlaceholderText("Search prompts, engines and styles...")
+        self.search_input.setClearButtonEnabled(True)
+        self.result_label = QtWidgets.QLabel()
+
+        # Reuse the gallery view (thumbnails, double-click to open) over the catalog model
+        self.results = ThumbnailGallery()
+        self.catalog_model = CatalogModel(catalog, ThumbnailCache(cache_bytes), self)
+        self.results.setModel(self.catalog_model)
+
+        # Wait for a pause in typing before querying
+        self.search_timer = QtCore.QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(SEARCH_DELAY_MS)
+        self.search_timer.timeout.connect(self.run_search)
+        self.search_input.textChanged.connect(self.search_timer.start)
+
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.search_input)
+        layout.addWidget(self.results)
+        layout.addWidget(self.result_label)
+        self.resize(800, 700)
+
+    def showEvent(self, event):
+        # Show the newest images whenever the panel is opened
+        super().showEvent(event)
+        self.run_search()
+
+    def run_search(self):
+        self.catalog_model.search(self.search_input.text())
+        count = self.catalog_model.rowCount()
+        more = "+" if self.catalog_model.canFetchMore() else ""
+        self.result_label.setText(
+            f"{count}{more} images in {self.catalog_model.last_query_seconds * 1000:.0f}ms")
@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# Local generation daemon shared by the front-ends
+# Holds the API keys, the pooled HTTP client, the rate limiter and the result
+# cache for every front-end on the machine, so an interactive request and a
+# running batch no longer compete for the same key's quota behind each other's
+# backs. Requests wait in one priority queue: interactive ones go first and
+# always have a worker kept free for them, live previews come next, and batch
+# work fills the rest.
+#
+# The daemon speaks the Stability text-to-image API on localhost (X-Priority
+# and X-Provider headers pick the queue and the provider), so the front-ends
+# reuse their streaming decoder through providers.DaemonProvider. They find it
+# at DSIMG_DAEMON_URL and fall back to calling the API directly without it.
+# Every request must carry the token the daemon keeps in DSIMG_DAEMON_TOKEN_FILE
+# (created 0600 on first start) and JSON bodies must say so, so neither other
+# users nor a web page posting to localhost can spend the API keys:
+#
+#   python generation_daemon.py --providers providers.json
+#   python generation_daemon.py --api-key-file api_key.txt --deepai-key-file deepai_key.txt
+
+import argparse
+import base64
+import heapq
+import hmac
+import itertools
+import json
+import os
+import re
+import secrets
+import shutil
+import sys
+import tempfile
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from api_client import ApiError, get_client
+from generation_settings import read_api_key
+from metrics import metrics
+from providers import (
+    DAEMON_TOKEN_FILE,
+    DAEMON_URL,
+    PRIORITIES,
+    PROVIDER_TYPES,
+    STABILITY_HOST,
+    DeepAIProvider,
+    StabilityProvider,
+    capabilities_to_json,
+    pool_of,
+    provider_from_config,
+    read_daemon_token,
+    read_provider_config,
+)
+from rate_limiter import RateLimiter
+from result_cache import ResultCache, make_key
+
+TEXT_TO_IMAGE_PATH = re.compile(r"^/v1/generation/([^/]+)/text-to-image$")
+
+DEFAULT_WORKERS = 8
+
+# Workers batch requests may never take, so interactive ones start at once
+RESERVED_INTERACTIVE_WORKERS = 1
+
+# Raw bytes base64-encoded per write; a multiple of 3 so chunks concatenate
+ENCODE_CHUNK_SIZE = 48 * 1024
+
+
+class PriorityScheduler:
+    # Runs submitted calls on a fixed set of worker threads, lowest priority
+    # value first and in submission order within a priority. Requests already
+    # sent upstream are never interrupted; pre-emption means jumping the queue
+    # and the reserved workers. Every worker still goes through the provider's
+    # rate limiter, so that should allow as many concurrent requests as there
+    # are workers.
+    def __init__(self, workers=DEFAULT_WORKERS, reserved=RESERVED_INTERACTIVE_WORKERS):
+        self.workers = max(1, workers)
+        self.batch_workers = max(1, self.workers - reserved)
+        self.urgent = min(PRIORITIES.values())
+        self.queued = {name: 0 for name in PRIORITIES}
+        self.running = {name: 0 for name in PRIORITIES}
+        self._names = {level: name for name, level in PRIORITIES.items()}
+        self._heap = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._threads = [threading.Thread(target=self._run, name=f"daemon-worker-{i}", daemon=True)
+                         for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, priority, fn, *args):
+        future = Future()
+        level = PRIORITIES[priority]
+        with self._condition:
+            heapq.heappush(self._heap, (level, next(self._order), future, fn, args))
+            self.queued[priority] += 1
+            self._condition.notify_all()
+        return future
+
+    def _next(self):
+        with self._condition:
+            while True:
+                if self._closed:
+                    return None
+                if self._heap:
+                    level = self._heap[0][0]
+                    busy = sum(count for name, count in self.running.items() if PRIORITIES[name] != self.urgent)
+                    if level == self.urgent or busy < self.batch_workers:
+                        item = heapq.heappop(self._heap)
+                        name = self._names[level]
+                        self.queued[name] -= 1
+                        self.running[name] += 1
+                        return name, item
+                self._condition.wait()
+
+    def _run(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            name, (level, _, future, fn, args) = job
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(*args))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._condition:
+                    self.running[name] -= 1
+                    self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            for _, _, future, _, _ in self._heap:
+                future.cancel()
+            self._heap = []
+            self._condition.notify_all()
+
+
+class DaemonHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        expected = f"Bearer {self.server.token}"
+        return hmac.compare_digest(self.headers.get("Authorization", "").encode(), expected.encode())
+
+    def do_GET(self):
+        if not self._authorized():
+            self._send_json(401, {"message": "missing or wrong daemon token"})
+            return
+        if self.path == "/status":
+            self._send_json(200, self.server.status())
+            return
+        self._send_json(404, {"message": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        match = TEXT_TO_IMAGE_PATH.match(self.path)
+        if not match:
+            self._send_json(404, {"message": "not found"})
+            return
+        if not self._authorized():
+            self._send_json(401, {"message": "missing or wrong daemon token"})
+            return
+        # Browsers send form and text/plain posts cross-origin without asking first
+        if self.headers.get_content_type() != "application/json":
+            self._send_json(415, {"message": "expected application/json"})
+            return
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            self._send_json(400, {"message": "invalid JSON"})
+            return
+        priority = self.headers.get("X-Priority", "batch")
+        provider_type = self.headers.get("X-Provider", "stability")
+        if priority not in PRIORITIES:
+            self._send_json(400, {"message": f"unknown priority: {priority}"})
+            return
+        if provider_type not in self.server.providers:
+            self._send_json(400, {"message": f"no {provider_type} provider configured"})
+            return
+
+        try:
+            artifacts, paths, owned = self.server.generate(provider_type, match.group(1), payload, priority)
+        except ApiError as e:
+            headers = {}
+            if e.retry_after is not None:
+                headers["Retry-After"] = str(int(e.retry_after))
+            self._send_json(e.status_code, {"message": str(e)}, headers)
+            return
+        except ValueError as e:
+            self._send_json(400, {"message": str(e)})
+            return
+        except Exception as e:
+            self._send_json(502, {"message": str(e)})
+            return
+
+        try:
+            self._send_artifacts(artifacts, paths)
+        finally:
+            if owned:
+                for path in paths:
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def _send_artifacts(self, artifacts, paths):
+        # The Stability response format, with each image base64-encoded from
+        # its file chunk by chunk rather than held in memory
+        parts = []
+        for artifact, path in zip(artifacts, paths):
+            fields = {name: value for name, value in artifact.items() if name != "base64"}
+            tail = b'"}' if not fields else b'",' + json.dumps(fields).encode("utf-8")[1:]
+            parts.append((path, os.path.getsize(path), tail))
+
+        head = b'{"artifacts":['
+        length = len(head) + len(b"]}") + max(0, len(parts) - 1)
+        for _, size, tail in parts:
+            length += len(b'{"base64":"') + 4 * ((size + 2) // 3) + len(tail)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+        self.wfile.write(head)
+        for i, (path, _, tail) in enumerate(parts):
+            if i:
+                self.wfile.write(b",")
+            self.wfile.write(b'{"base64":"')
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(ENCODE_CHUNK_SIZE), b""):
+                    self.wfile.write(base64.b64encode(chunk))
+            self.wfile.write(tail)
+        self.wfile.write(b"]}")
+
+
+class GenerationDaemon(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, providers, host="127.0.0.1", port=0, workers=DEFAULT_WORKERS, cache=None, token=None):
+        # providers: provider type ("stability", "deepai") -> provider or pool;
+        # without a token a random one is made (see self.token)
+        super().__init__((host, port), DaemonHandler)
+        self.providers = providers
+        self.token = token or secrets.token_urlsafe(32)
+        self.cache = cache
+        self.scheduler = PriorityScheduler(workers)
+        self.spool_dir = tempfile.mkdtemp(prefix="dsimg-daemon-")
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def cache_key(self, provider_type, engine_id, payload):
+        # Only seeded single images are deterministic enough to share; keys
+        # match the batch engine's, so both see the same cache entries
+        if self.cache is None or provider_type != "stability":
+            return None
+        if not payload.get("seed") or payload.get("samples", 1) != 1:
+            return None
+        return make_key(engine_id, payload)
+
+    def generate(self, provider_type, engine_id, payload, priority):
+        # Blocks the calling (connection) thread until the request has run;
+        # returns (artifacts, paths, owned), owned meaning the paths are
+        # spool files for the caller to remove once sent
+        key = self.cache_key(provider_type, engine_id, payload)
+        if key is not None:
+            path = self.cache.lookup(key)
+            if path is not None:
+                return [{"seed": payload["seed"], "finishReason": "SUCCESS"}], [path], False
+
+        metrics.incr(f"queued_{priority}")
+        future = self.scheduler.submit(priority, self._generate, provider_type, engine_id, payload)
+        artifacts, paths = future.result()
+        if key is not None and artifacts:
+            self.cache.put_file(key, paths[0])
+        return artifacts, paths, True
+
+    def _generate(self, provider_type, engine_id, payload):
+        # Runs on a scheduler worker: the request with the provider's own
+        # rate limiting and retries, decoded into spool files
+        samples = int(payload.get("samples", 1))
+        paths = []
+        for _ in range(samples):
+            fd, path = tempfile.mkstemp(dir=self.spool_dir, suffix=".png")
+            os.close(fd)
+            paths.append(path)
+        files = {}
+
+        def open_artifact(index):
+            if index >= len(paths):
+                return None
+            if index in files:
+                files[index].close()
+            f = files[index] = open(paths[index], "wb")
+            return f
+
+        try:
+            with metrics.span("daemon_request", provider=provider_type):
+                artifacts = self.providers[provider_type].generate(engine_id, payload, open_artifact)
+        except BaseException:
+            for path in paths:
+                os.remove(path)
+            raise
+        finally:
+            for f in files.values():
+                f.close()
+        for path in paths[len(artifacts):]:
+            os.remove(path)
+        return artifacts, paths[:len(artifacts)]
+
+    def status(self):
+        scheduler = self.scheduler
+        return {
+            "providers": {name: capabilities_to_json(provider.capabilities)
+                          for name, provider in self.providers.items()},
+            "workers": scheduler.workers,
+            "queued": dict(scheduler.queued),
+            "running": dict(scheduler.running),
+            "cache": None if self.cache is None else self.cache.stats_text(),
+            "counters": dict(metrics.counters),
+        }
+
+    def start(self):
+        # Serve from a background thread; returns self so it can be chained
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.scheduler.close()
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+
+def load_token(path):
+    # The token in path, creating it first if needed; only this user may read it
+    token = read_daemon_token(path)
+    if token is None:
+        token = secrets.token_urlsafe(32)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(token + "\n")
+    os.chmod(path, 0o600)
+    return token
+
+
+def build_providers(args, client):
+    # One provider (or pool) per type, from --providers or the key files
+    providers = {}
+    if args.providers:
+        by_type = {}
+        for entry in read_provider_config(args.providers):
+            by_type.setdefault(entry.get("type", "stability"), []).append(provider_from_config(entry, client))
+        providers = {name: pool_of(members) for name, members in by_type.items()}
+    if "stability" not in providers and os.path.exists(args.api_key_file):
+        rate = float(os.getenv("API_RATE_LIMIT", "15"))
+        limiter = RateLimiter(rate=rate, burst=max(1, rate), initial_concurrency=args.workers,
+                              max_concurrency=max(32, args.workers))
+        providers["stability"] = StabilityProvider(
+            read_api_key(args.api_key_file), args.api_host, limiter=limiter, client=client)
+    if "deepai" not in providers and args.deepai_key_file:
+        providers["deepai"] = DeepAIProvider(read_api_key(args.deepai_key_file), client=client)
+    return providers
+
+
+def main(argv=None):
+    default = urlsplit(DAEMON_URL or "http://127.0.0.1:8766")
+    parser = argparse.ArgumentParser(description="Local generation daemon shared by the front-ends")
+    parser.add_argument("--host", default=default.hostname or "127.0.0.1")
+    parser.add_argument("--port", type=int, default=default.port or 8766)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="requests sent upstream at once")
+    parser.add_argument("--providers", help=f"JSON file of providers ({', '.join(PROVIDER_TYPES)})")
+    parser.add_argument("--api-key-file", default="api_key.txt", help="Stability key, unless --providers has one")
+    parser.add_argument("--api-host", default=STABILITY_HOST)
+    parser.add_argument("--deepai-key-file", help="enables DeepAI requests (QtText2Img)")
+    parser.add_argument("--no-cache", action="store_true", help="don't read or write the result cache")
+    parser.add_argument("--token-file", default=DAEMON_TOKEN_FILE, help="token the front-ends must send")
+    args = parser.parse_args(argv)
+
+    client = get_client(args.workers)
+    providers = build_providers(args, client)
+    if not providers:
+        parser.error("no providers: pass --providers or an existing --api-key-file")
+
+    daemon = GenerationDaemon(providers, args.host, args.port, workers=args.workers,
+                              cache=None if args.no_cache else ResultCache(), token=load_token(args.token_file))
+    print(f"Serving {', '.join(providers)} on {daemon.url} with {daemon.scheduler.workers} workers", flush=True)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+        daemon.scheduler.close()
+        shutil.rmtree(daemon.spool_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
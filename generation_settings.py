@@ -0,0 +1,66 @@
+# Engine and style choices and batch settings shared by the generators
+# Kept free of heavy imports so the front-ends can build their windows
+# without loading the engine, HTTP client or image codecs.
+
+ENGINE_IDS = [
+    "stable-diffusion-v1",
+    "stable-diffusion-v1-5",
+    "stable-diffusion-512-v2-0",
+    "stable-diffusion-768-v2-0",
+    "stable-diffusion-512-v2-1",
+    "stable-diffusion-768-v2-1",
+    "stable-diffusion-xl-beta-v2-2-2",
+    "stable-inpainting-v1-0",
+    "stable-inpainting-512-v2-0"
+]
+
+STYLE_PRESETS = [
+    "3d-model",
+    "analog-film",
+    "anime",
+    "cinematic",
+    "comic-book",
+    "digital-art",
+    "enhance",
+    "fantasy-art",
+    "isometric",
+    "line-art",
+    "low-poly",
+    "modeling-compound",
+    "neon-punk",
+    "origami",
+    "photographic",
+    "pixel-art",
+    "tile-texture"
+]
+
+DEFAULT_ENGINE_ID = "stable-diffusion-512-v2-1"
+DEFAULT_STYLE_PRESET = "enhance"
+
+
+def default_size(engine_id):
+    # Set the default width and height based on the engine_id
+    if '768' in engine_id:
+        return 768, 768
+    return 512, 512
+
+
+def read_api_key(path="api_key.txt"):
+    # Read the API key from api_key.txt
+    with open(path, "r") as f:
+        return f.readline().strip()
+
+
+def make_settings(filename, engine_id, style_preset, cfg_scale, iterations, numbering=True):
+    # Everything needed to (re)create a batch run; stored in the job journal
+    width, height = default_size(engine_id)
+    return {
+        "filename": filename,
+        "style_preset": style_preset,
+        "engine_id": engine_id,
+        "cfg_scale": cfg_scale,
+        "width": width,
+        "height": height,
+        "iterations": iterations,
+        "numbering": numbering,
+    }
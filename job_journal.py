@@ -0,0 +1,77 @@
+# Append-only checkpoint journal for batch runs
+# Each (iteration, prompt) unit is logged as pending, done or failed in a JSONL
+# file next to the images, so an interrupted batch can be resumed.
+
+import json
+import os
+import threading
+import time
+
+JOURNAL_NAME = ".batch_journal.jsonl"
+
+
+def unit_id(iteration, index):
+    return f"{iteration}:{index}"
+
+
+def journal_path(output_dir):
+    return os.path.join(output_dir, JOURNAL_NAME)
+
+
+def load_journal(output_dir):
+    # Replay the journal; only records after the most recent "start" count.
+    # Returns (settings, {unit: last record}) or None when there is no journal.
+    path = journal_path(output_dir)
+    if not os.path.exists(path):
+        return None
+
+    settings = None
+    units = {}
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A torn final line from a crash mid-write
+                continue
+            if record.get("event") == "start":
+                settings = record["settings"]
+                units = {}
+            elif "unit" in record:
+                units[record["unit"]] = record
+
+    if settings is None:
+        return None
+    return settings, units
+
+
+def completed_units(units):
+    return {unit for unit, record in units.items() if record["state"] == "done"}
+
+
+class JobJournal:
+    def __init__(self, output_dir):
+        self.path = journal_path(output_dir)
+        self._lock = threading.Lock()
+        self._file = open(self.path, "a")
+
+    def _append(self, record):
+        record["time"] = time.time()
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def start(self, settings):
+        self._append({"event": "start", "settings": settings})
+
+    def resume(self):
+        self._append({"event": "resume"})
+
+    def record(self, unit, state, **fields):
+        fields.update({"unit": unit, "state": state})
+        self._append(fields)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
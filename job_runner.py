@@ -0,0 +1,111 @@
+# Background job runner shared by the Qt front-ends
+# Jobs run on a QThreadPool and talk to the GUI thread only through signals,
+# so network I/O never blocks the event loop.
+
+import threading
+
+from qtpy import QtCore
+
+# Intermediate results emitted but not yet delivered to the GUI thread before
+# emit_result() blocks, so a busy event loop holds up the job instead of
+# queueing results without bound
+MAX_PENDING_RESULTS = 64
+
+
+class JobSignals(QtCore.QObject):
+    progress = QtCore.Signal(int, int)
+    status = QtCore.Signal(str)
+    result = QtCore.Signal(object)
+    warning = QtCore.Signal(str)
+    error = QtCore.Signal(str)
+    cancelled = QtCore.Signal()
+    finished = QtCore.Signal()
+
+
+class Job(QtCore.QRunnable):
+    # fn is called as fn(job, *args, **kwargs) on a pool thread. It can report
+    # intermediate results with job.emit_result() and should poll
+    # job.is_cancelled() between units of work.
+    def __init__(self, fn, *args, **kwargs):
+        super().__init__()
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = JobSignals()
+        self._cancel_event = threading.Event()
+        self._pending_results = 0
+        self._delivered = threading.Condition()
+        # Connected first, so it runs on the GUI thread as each result arrives
+        self.signals.result.connect(self._result_delivered)
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def is_cancelled(self):
+        return self._cancel_event.is_set()
+
+    def emit_progress(self, done, total):
+        self.signals.progress.emit(done, total)
+
+    def emit_status(self, message):
+        self.signals.status.emit(message)
+
+    def emit_warning(self, message):
+        # A non-fatal problem, e.g. one unit of a batch failing
+        self.signals.warning.emit(message)
+
+    def emit_result(self, value):
+        with self._delivered:
+            # A cancelled job stops waiting; the GUI may be closing
+            while self._pending_results >= MAX_PENDING_RESULTS and not self.is_cancelled():
+                self._delivered.wait(0.1)
+            self._pending_results += 1
+        self.signals.result.emit(value)
+
+    def _result_delivered(self, value):
+        with self._delivered:
+            # The final result from run() was never counted
+            self._pending_results = max(0, self._pending_results - 1)
+            self._delivered.notify()
+
+    def run(self):
+        try:
+            value = self.fn(self, *self.args, **self.kwargs)
+        except Exception as e:
+            self.signals.error.emit(str(e))
+        else:
+            if self.is_cancelled():
+                self.signals.cancelled.emit()
+            elif value is not None:
+                self.signals.result.emit(value)
+        finally:
+            self.signals.finished.emit()
+
+
+class JobRunner(QtCore.QObject):
+    def __init__(self, max_threads=2, parent=None):
+        super().__init__(parent)
+        self.pool = QtCore.QThreadPool(self)
+        self.pool.setMaxThreadCount(max_threads)
+
+        # Keep submitted jobs (and their signal objects) alive until they finish
+        self._jobs = set()
+
+    def submit(self, fn, *args, **kwargs):
+        job = Job(fn, *args, **kwargs)
+        self._jobs.add(job)
+        job.signals.finished.connect(lambda: self._jobs.discard(job))
+        self.pool.start(job)
+        return job
+
+    def active_jobs(self):
+        return list(self._jobs)
+
+    def cancel_all(self):
+        for job in list(self._jobs):
+            job.cancel()
+
+    def shutdown(self, wait=True):
+        self.cancel_all()
+        if wait:
+            self.pool.waitForDone()
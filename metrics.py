@@ -0,0 +1,173 @@
+# Hot-path instrumentation shared by the engine, API client and front-ends
+# Timing spans per pipeline stage plus counters (requests, retries, bytes,
+# cache hits) and gauges (queue depths, bytes in flight), viewable live and exportable as Prometheus text or as a
+# Chrome trace-event file that loads into chrome://tracing / Perfetto.
+
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Samples kept per stage for percentiles, and trace events kept in memory
+STAGE_SAMPLES = 10000
+TRACE_EVENTS = 100000
+
+
+def metric_name(name):
+    # Counter names can include user-chosen parts (e.g. provider names from
+    # providers.json); Prometheus only allows [a-zA-Z0-9_:] in metric names
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def percentile(values, pct):
+    # Nearest-rank percentile; 0.0 for an empty sample
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._trace_file = None
+        self.reset()
+
+    def reset(self, trace_events=TRACE_EVENTS):
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+            self._stage_totals = {}
+            self._stage_counts = {}
+            self._stage_samples = {}
+            # (name, ts, dur, tid, args) tuples; the event dicts are only built on export
+            self._events = deque(maxlen=trace_events)
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def add_time(self, stage, seconds, start=None, args=None):
+        # Record one timing for stage; with a start time it also becomes a trace event
+        with self._lock:
+            self._stage_totals[stage] = self._stage_totals.get(stage, 0.0) + seconds
+            self._stage_counts[stage] = self._stage_counts.get(stage, 0) + 1
+            samples = self._stage_samples.get(stage)
+            if samples is None:
+                samples = self._stage_samples[stage] = deque(maxlen=STAGE_SAMPLES)
+            samples.append(seconds)
+            if start is None:
+                return
+            event = (stage, round((start - self._origin) * 1e6, 1), round(seconds * 1e6, 1),
+                     threading.get_ident(), args)
+            self._events.append(event)
+            if self._trace_file is not None:
+                self._trace_file.write(json.dumps(self._trace_event(event)) + ",\n")
+
+    @staticmethod
+    def _trace_event(event):
+        name, ts, dur, tid, args = event
+        trace_event = {"name": name, "ph": "X", "ts": ts, "dur": dur, "pid": os.getpid(), "tid": tid}
+        if args:
+            trace_event["args"] = args
+        return trace_event
+
+    @contextmanager
+    def span(self, stage, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start, start, args or None)
+
+    def stage_summary(self):
+        with self._lock:
+            return {
+                stage: {
+                    "count": self._stage_counts[stage],
+                    "total": total,
+                    "mean": total / self._stage_counts[stage],
+                    "p50": percentile(self._stage_samples[stage], 50),
+                    "p95": percentile(self._stage_samples[stage], 95),
+                    "p99": percentile(self._stage_samples[stage], 99),
+                }
+                for stage, total in self._stage_totals.items()
+            }
+
+    def status_text(self):
+        # One-line summary for a status bar
+        with self._lock:
+            counters = dict(self.counters)
+            means = {stage: total / self._stage_counts[stage] for stage, total in self._stage_totals.items()}
+        parts = [
+            f"requests {counters.get('requests', 0)}",
+            f"retries {counters.get('retries', 0)}",
+            f"{counters.get('bytes_received', 0) / (1024 * 1024):.1f} MiB in",
+            f"cache {counters.get('cache_hits', 0)}/{counters.get('cache_hits', 0) + counters.get('cache_misses', 0)}",
+        ]
+        for stage in ("network", "decode", "write", "preview", "layout"):
+            if stage in means:
+                parts.append(f"{stage} {means[stage] * 1000:.0f}ms")
+        return " | ".join(parts)
+
+    def prometheus_text(self, prefix="dsimg"):
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                name = metric_name(name)
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                lines.append(f"{prefix}_{name}_total {value}")
+            for name, value in sorted(self.gauges.items()):
+                name = metric_name(name)
+                lines.append(f"# TYPE {prefix}_{name} gauge")
+                lines.append(f"{prefix}_{name} {value}")
+            if self._stage_totals:
+                lines.append(f"# TYPE {prefix}_stage_seconds summary")
+            for stage, total in sorted(self._stage_totals.items()):
+                samples = self._stage_samples[stage]
+                for quantile in (0.5, 0.95, 0.99):
+                    lines.append(f'{prefix}_stage_seconds{{stage="{stage}",quantile="{quantile}"}} '
+                                 f'{percentile(samples, quantile * 100):.6f}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {self._stage_counts[stage]}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        with open(path, "w") as f:
+            f.write(self.prometheus_text())
+
+    def write_trace(self, path):
+        # Chrome trace-event JSON, one event per line, from the in-memory buffer
+        with self._lock:
+            events = list(self._events)
+        with open(path, "w") as f:
+            f.write("[\n")
+            f.write(",\n".join(json.dumps(self._trace_event(event)) for event in events))
+            f.write("\n]\n")
+
+    def start_trace(self, path):
+        # Stream events to path as they happen. The trace-event format allows the
+        # closing bracket to be missing, so the file stays loadable after a crash.
+        with self._lock:
+            self._trace_file = open(path, "w", buffering=1)
+            self._trace_file.write("[\n")
+
+    def stop_trace(self):
+        with self._lock:
+            if self._trace_file is not None:
+                self._trace_file.write("{}]\n")
+                self._trace_file.close()
+                self._trace_file = None
+
+
+metrics = Metrics()
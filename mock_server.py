@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# Local stand-in for the Stability and DeepAI text-to-image APIs
+# Serves valid PNGs of a configurable size with configurable latency, jitter
+# and error/429 injection, so the generators can be exercised and benchmarked
+# without paid API calls:
+#
+#   python mock_server.py --port 8765 --latency 0.5 --throttle-rate 0.05
+#   API_HOST=http://127.0.0.1:8765 DEEPAI_HOST=http://127.0.0.1:8765 python batchQtDSimg2.py
+
+import argparse
+import base64
+import json
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TEXT_TO_IMAGE_PATH = re.compile(r"^/v1/generation/([^/]+)/text-to-image$")
+
+
+def make_png(payload_bytes, width=64, height=64):
+    # A valid, decodable PNG padded with a private ancillary chunk up to
+    # roughly payload_bytes, so decoders see realistic file sizes
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data
+                + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+    rows = b"".join(b"\x00" + b"".join(bytes([x * 4 % 256, y * 4 % 256, 128]) for x in range(width))
+                    for y in range(height))
+    png = (b"\x89PNG\r\n\x1a\n"
+           + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+           + chunk(b"IDAT", zlib.compress(rows)))
+    padding = max(0, payload_bytes - len(png) - 24)
+    if padding:
+        png += chunk(b"paDd", random.Random(0).randbytes(padding))
+    return png + chunk(b"IEND", b"")
+
+
+class MockConfig:
+    def __init__(self, latency=0.2, jitter=0.05, error_rate=0.0, throttle_rate=0.0,
+                 retry_after=1.0, payload_bytes=500 * 1024, max_samples=10):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.payload_bytes = payload_bytes
+        self.max_samples = max_samples
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, data, headers=None):
+        self._send(status, json.dumps(data).encode("utf-8"), headers=headers)
+
+    def _simulate(self):
+        # Sleep for the configured latency, then maybe inject a failure.
+        # Returns True if an error response was sent.
+        config = self.server.config
+        time.sleep(max(0.0, config.latency + random.uniform(-config.jitter, config.jitter)))
+        roll = random.random()
+        if roll < config.throttle_rate:
+            self.server.count("throttled")
+            self._send_json(429, {"message": "rate limited"}, {"Retry-After": str(config.retry_after)})
+            return True
+        if roll < config.throttle_rate + config.error_rate:
+            self.server.count("errors")
+            self._send_json(500, {"message": "injected failure"})
+            return True
+        return False
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def do_POST(self):
+        body = self._read_body()
+        self.server.count("requests")
+
+        match = TEXT_TO_IMAGE_PATH.match(self.path)
+        if match:
+            if self._simulate():
+                return
+            try:
+                payload = json.loads(body or b"{}")
+            except ValueError:
+                self._send_json(400, {"message": "invalid JSON"})
+                return
+            samples = int(payload.get("samples", 1))
+            if not 1 <= samples <= self.server.config.max_samples:
+                self._send_json(400, {"message": "samples out of range"})
+                return
+            self.server.count("images", samples)
+            self._send_artifacts(samples)
+            return
+
+        if self.path == "/api/text2img":
+            if self._simulate():
+                return
+            host = self.headers.get("Host", "%s:%d" % self.server.server_address[:2])
+            self.server.count("images")
+            self._send_json(200, {"output_url": f"http://{host}/download/{random.randrange(2 ** 32)}.png"})
+            return
+
+        self._send_json(404, {"message": "not found"})
+
+    def _send_artifacts(self, samples):
+        # Stitch the pre-encoded image into the response instead of re-encoding per request
+        encoded = self.server.encoded_image
+        parts = []
+        for _ in range(samples):
+            seed = random.randrange(2 ** 32)
+            parts.append(b'{"base64":"' + encoded + b'","seed":' + str(seed).encode() + b',"finishReason":"SUCCESS"}')
+        self._send(200, b'{"artifacts":[' + b",".join(parts) + b"]}")
+
+    def do_GET(self):
+        self.server.count("requests")
+        if self.path.startswith("/download/"):
+            self._send(200, self.server.image, content_type="image/png")
+            return
+        if self.path == "/stats":
+            self._send_json(200, self.server.snapshot())
+            return
+        self._send_json(404, {"message": "not found"})
+
+
+class MockApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0, config=None):
+        super().__init__((host, port), MockHandler)
+        self.config = config or MockConfig()
+        self.image = make_png(self.config.payload_bytes)
+        self.encoded_image = base64.b64encode(self.image)
+        self._counters = {}
+        self._counter_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name, amount=1):
+        with self._counter_lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def snapshot(self):
+        with self._counter_lock:
+            return dict(self._counters)
+
+    def start(self):
+        # Serve from a background thread; returns self so it can be chained
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def add_config_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.2, help="mean response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="uniform +/- latency jitter in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--payload-kb", type=int, default=500, help="size of each generated PNG in KiB")
+
+
+def config_from_args(args):
+    return MockConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        payload_bytes=args.payload_kb * 1024,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mock Stability/DeepAI text-to-image server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+
+    server = MockApiServer(args.host, args.port, config_from_args(args))
+    print(f"Mock API listening on {server.url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# Bounds on the work a batch run holds between its pipeline stages
+# Requests (decoding their responses as they stream in) feed the writer
+# thread, which feeds the post-processing pool, which feeds the caller (e.g.
+# the gallery). Every hand-off is bounded, and a new request is only started
+# while the images already in flight fit a byte budget. Over a run of any
+# length a slow disk, encoder or UI then pushes back on the requests instead
+# of letting finished images pile up, and memory and temp-file use stay flat.
+
+import os
+
+from asset_writer import DEFAULT_QUEUE_SIZE
+
+DEFAULT_MAX_INFLIGHT_BYTES = int(os.getenv("BATCH_MAX_INFLIGHT_MB", "256")) * 1024 * 1024
+
+# Size assumed for an image until the first one has been written
+DEFAULT_IMAGE_BYTES = 1024 * 1024
+
+
+class PipelineLimits:
+    def __init__(self, max_inflight_bytes=DEFAULT_MAX_INFLIGHT_BYTES, write_queue=DEFAULT_QUEUE_SIZE,
+                 max_processing=None):
+        self.max_inflight_bytes = max_inflight_bytes
+        # Finished images waiting for the writer thread before requests block
+        self.write_queue = write_queue
+        # Images handed to post-processing and not back yet; two per worker by default
+        self.max_processing = max_processing or 2 * (os.cpu_count() or 1)
+
+
+class ByteBudget:
+    # Bytes held by images between their request and the end of the pipeline.
+    # An image counts at the average size of those written so far until its
+    # own size is known. Only used from the thread running the batch.
+    def __init__(self, max_bytes, initial_estimate=DEFAULT_IMAGE_BYTES):
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self._initial_estimate = initial_estimate
+        self._measured_bytes = 0
+        self._measured_count = 0
+
+    def estimate(self):
+        if not self._measured_count:
+            return self._initial_estimate
+        return self._measured_bytes // self._measured_count
+
+    def fits(self, images):
+        # With nothing in flight anything fits, so one oversized group cannot stall the run
+        return self.in_use == 0 or self.in_use + images * self.estimate() <= self.max_bytes
+
+    def reserve(self):
+        # Reserves one image at the current estimate; returns the amount
+        amount = self.estimate()
+        self.in_use += amount
+        return amount
+
+    def measured(self, reserved, size):
+        # Swap an image's reservation for its real size; returns the new amount
+        self._measured_bytes += size
+        self._measured_count += 1
+        self.in_use += size - reserved
+        return size
+
+    def release(self, amount):
+        self.in_use -= amount
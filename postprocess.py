@@ -0,0 +1,144 @@
+# Optional post-processing of finished images in a process pool
+# Transcodes the raw PNGs to WebP/JPEG/AVIF, writes downscaled previews and
+# embeds the generation parameters (PNG text chunks, or EXIF for the other
+# formats). Encoding is CPU-bound, so it runs in worker processes and never
+# holds the GIL of the request threads or the UI. Needs Pillow, which is only
+# imported once post-processing is actually used:
+#
+#   python -m batch_engine prompts.txt --format webp --quality 85 --preview-size 256 --embed-metadata
+
+import json
+import os
+
+from api_client import write_atomically
+
+FORMATS = ["png", "webp", "jpeg", "avif"]
+
+EXTENSIONS = {
+    "png": ".png",
+    "webp": ".webp",
+    "jpeg": ".jpg",
+    "avif": ".avif",
+}
+
+PREVIEW_DIR = "previews"
+
+# EXIF tags used for the generation parameters
+EXIF_IMAGE_DESCRIPTION = 0x010E
+EXIF_SOFTWARE = 0x0131
+EXIF_IFD = 0x8769
+EXIF_USER_COMMENT = 0x9286
+
+
+class PostProcessError(Exception):
+    pass
+
+
+class PostProcessOptions:
+    def __init__(self, format="png", quality=90, preview_size=None, embed_metadata=False):
+        if format not in FORMATS:
+            raise PostProcessError(f"Unknown output format: {format}")
+        self.format = format
+        self.quality = quality
+        self.preview_size = preview_size
+        self.embed_metadata = embed_metadata
+
+    @property
+    def enabled(self):
+        # Plain PNGs without previews or metadata need no post-processing
+        return self.format != "png" or bool(self.preview_size) or self.embed_metadata
+
+    def output_filename(self, filename):
+        # Images are named for their final format up front, so the name index
+        # sees the real extension and transcoding can happen in place
+        return os.path.splitext(filename)[0] + EXTENSIONS[self.format]
+
+
+def _save_options(image_format, quality, metadata):
+    from PIL import Image, PngImagePlugin
+
+    options = {}
+    if image_format != "png":
+        options["quality"] = quality
+    if not metadata:
+        return options
+
+    if image_format == "png":
+        info = PngImagePlugin.PngInfo()
+        info.add_text("parameters", json.dumps(metadata))
+        for key, value in metadata.items():
+            if value is not None:
+                info.add_text(key, str(value))
+        options["pnginfo"] = info
+    else:
+        exif = Image.Exif()
+        exif[EXIF_IMAGE_DESCRIPTION] = metadata.get("prompt", "")
+        exif[EXIF_SOFTWARE] = "dsimg"
+        # UserComment starts with an 8-byte character code
+        exif.get_ifd(EXIF_IFD)[EXIF_USER_COMMENT] = b"UNICODE\0" + json.dumps(metadata).encode("utf-16-be")
+        options["exif"] = exif
+    return options
+
+
+def _save(image, path, image_format, quality, metadata):
+    def write(f):
+        image.save(f, format=image_format.upper(), **_save_options(image_format, quality, metadata))
+
+    write_atomically(path, write)
+
+
+def process_image(path, options, metadata=None):
+    # Runs in a worker process. path holds the raw image under its final name
+    # and is rewritten in place; returns the preview's path or None.
+    from PIL import Image
+
+    metadata = metadata if options.embed_metadata else None
+    preview_path = None
+
+    with Image.open(path) as image:
+        image.load()
+        if options.format == "jpeg" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        if options.format != "png" or metadata:
+            _save(image, path, options.format, options.quality, metadata)
+
+        if options.preview_size:
+            preview_dir = os.path.join(os.path.dirname(path), PREVIEW_DIR)
+            os.makedirs(preview_dir, exist_ok=True)
+            preview_path = os.path.join(preview_dir, os.path.basename(path))
+            preview = image.copy()
+            preview.thumbnail((options.preview_size, options.preview_size), Image.LANCZOS)
+            _save(preview, preview_path, options.format, options.quality, None)
+    return preview_path
+
+
+def check_options(options):
+    # Raises PostProcessError if this installation cannot honor options
+    try:
+        from PIL import features
+    except ImportError:
+        raise PostProcessError("Post-processing needs Pillow (pip install Pillow)") from None
+    if options.format in ("webp", "avif") and not features.check(options.format):
+        raise PostProcessError(f"This Pillow build cannot write {options.format.upper()}")
+
+
+class PostProcessor:
+    def __init__(self, options, max_workers=None):
+        check_options(options)
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.options = options
+        self._executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    def submit(self, path, metadata=None):
+        return self._executor.submit(process_image, path, self.options, metadata)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self, wait=True):
+        self._executor.shutdown(wait=wait)
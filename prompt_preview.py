@@ -0,0 +1,73 @@
+# Model-backed preview of a prompt file
+# Rows are pulled from a PromptSource only as the view scrolls towards them
+# (Qt's canFetchMore/fetchMore), so opening a huge prompt file is instant and
+# nothing past the rows seen so far is ever read or kept.
+
+from itertools import islice
+
+from qtpy import QtCore, QtWidgets
+
+# Prompts read from the file per fetch
+FETCH_BATCH = 200
+
+
+class PromptListModel(QtCore.QAbstractListModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._prompts = []
+        self._iterator = None
+
+    def set_source(self, source):
+        self.beginResetModel()
+        if self._iterator is not None:
+            self._iterator.close()
+        self._prompts = []
+        self._iterator = iter(source) if source is not None else None
+        self.endResetModel()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._prompts)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        prompt = self._prompts[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            return prompt["text"]
+        if role == QtCore.Qt.ToolTipRole:
+            overrides = [f"{name}: {prompt[name]}" for name in ("negative_prompt", "weight", "cfg_scale", "seed")
+                         if name in prompt]
+            return "\n".join([prompt["text"]] + overrides)
+        return None
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        return not parent.isValid() and self._iterator is not None
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        if parent.isValid() or self._iterator is None:
+            return
+        batch = list(islice(self._iterator, FETCH_BATCH))
+        if len(batch) < FETCH_BATCH:
+            # End of file; release it
+            self._iterator.close()
+            self._iterator = None
+        if not batch:
+            return
+        row = len(self._prompts)
+        self.beginInsertRows(QtCore.QModelIndex(), row, row + len(batch) - 1)
+        self._prompts.extend(batch)
+        self.endInsertRows()
+
+
+class PromptPreview(QtWidgets.QListView):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.prompt_model = PromptListModel(self)
+        self.setModel(self.prompt_model)
+        self.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
+        self.setUniformItemSizes(True)
+
+    def set_source(self, source):
+        self.prompt_model.set_source(source)
@@ -0,0 +1,196 @@
+# Lazy prompt files for batch runs
+# Prompts are streamed from disk through a generator every time they are
+# iterated instead of being held in a list, so prompt files with hundreds of
+# thousands of lines cost a constant amount of memory. Besides plain text (one
+# prompt per line) CSV and JSONL files are read, whose rows may override the
+# batch settings per prompt:
+#
+#   text,negative_prompt,weight,cfg_scale,seed
+#   "a lighthouse at dusk",blurry,1.0,9,42
+#
+#   {"text": "a lighthouse at dusk", "negative_prompt": "blurry", "seed": 42}
+
+import csv
+import hashlib
+import json
+import math
+import os
+
+# Longest prompt the text-to-image endpoints accept
+MAX_PROMPT_CHARS = 2000
+MAX_SEED = 4294967295
+
+# Invalid lines remembered per pass for reporting; the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+OVERRIDE_FIELDS = ("negative_prompt", "weight", "cfg_scale", "seed", "filename")
+
+
+class PromptError(ValueError):
+    pass
+
+
+def prompt_format(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == ".csv":
+        return "csv"
+    if ext in (".jsonl", ".ndjson"):
+        return "jsonl"
+    return "text"
+
+
+# Readers yield (line number, fields); a line that cannot be parsed is
+# yielded as a PromptError so the rest of the file is still read
+
+def _read_text(f):
+    for line_no, line in enumerate(f, 1):
+        yield line_no, {"text": line}
+
+
+def _read_csv(f):
+    # The header names the columns; "prompt" is accepted for "text"
+    reader = csv.DictReader(f)
+    for row in reader:
+        if "text" not in row and "prompt" in row:
+            row["text"] = row.pop("prompt")
+        yield reader.line_num, row
+
+
+def _read_jsonl(f):
+    for line_no, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_no, PromptError(f"invalid JSON: {e}")
+            continue
+        if isinstance(record, str):
+            record = {"text": record}
+        elif not isinstance(record, dict):
+            record = PromptError("expected an object or a string")
+        yield line_no, record
+
+
+READERS = {
+    "text": _read_text,
+    "csv": _read_csv,
+    "jsonl": _read_jsonl,
+}
+
+
+def _number(fields, name, convert, minimum=None, maximum=None):
+    value = fields.get(name)
+    if value is None or value == "":
+        return None
+    try:
+        value = convert(value)
+    except (TypeError, ValueError):
+        raise PromptError(f"{name} is not a number: {value!r}") from None
+    if isinstance(value, float) and not math.isfinite(value):
+        raise PromptError(f"{name} is not finite")
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        raise PromptError(f"{name} {value} is outside {minimum}..{maximum}")
+    return value
+
+
+def make_prompt(fields, width, height):
+    # Validates one record; returns a prompt dict or None for a blank line
+    text = fields.get("text")
+    if not isinstance(text, str):
+        raise PromptError("missing prompt text")
+    text = text.strip()
+    if not text:
+        return None
+    if len(text) > MAX_PROMPT_CHARS:
+        raise PromptError(f"prompt is longer than {MAX_PROMPT_CHARS} characters")
+
+    prompt = {
+        "text": text,
+        "filename": text.replace(" ", "_").replace("\n", "_") + ".png",
+        "width": width,
+        "height": height,
+    }
+    negative_prompt = fields.get("negative_prompt")
+    if negative_prompt:
+        prompt["negative_prompt"] = str(negative_prompt).strip()
+    filename = fields.get("filename")
+    if filename:
+        prompt["filename"] = os.path.basename(str(filename))
+    for name, value in (
+        ("weight", _number(fields, "weight", float)),
+        ("cfg_scale", _number(fields, "cfg_scale", float, 0, 35)),
+        ("seed", _number(fields, "seed", int, 0, MAX_SEED)),
+    ):
+        if value is not None:
+            prompt[name] = value
+    return prompt
+
+
+def _dedupe_key(prompt):
+    # A 64-bit digest per prompt keeps the seen-set small for huge files
+    key = json.dumps([prompt["text"]] + [prompt.get(name) for name in OVERRIDE_FIELDS])
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class PromptSource:
+    # Re-iterable: every iteration streams the file again, yielding validated
+    # prompt dicts in file order. Blank lines are skipped; invalid ones are
+    # skipped and reported through errors/skipped for the latest pass.
+    def __init__(self, filename, width, height, dedupe=True):
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.dedupe = dedupe
+        self.format = prompt_format(filename)
+        self.errors = []
+        self.skipped = 0
+        self.duplicates = 0
+        self._count = None
+
+    def __iter__(self):
+        self.errors = []
+        self.skipped = 0
+        self.duplicates = 0
+        seen = set()
+        count = 0
+        with open(self.filename, "r", newline="" if self.format == "csv" else None) as f:
+            for line_no, fields in READERS[self.format](f):
+                try:
+                    if isinstance(fields, PromptError):
+                        raise fields
+                    prompt = make_prompt(fields, self.width, self.height)
+                except PromptError as e:
+                    self._invalid(line_no, e)
+                    continue
+                if prompt is None:
+                    continue
+                if self.dedupe:
+                    key = _dedupe_key(prompt)
+                    if key in seen:
+                        self.duplicates += 1
+                        continue
+                    seen.add(key)
+                count += 1
+                yield prompt
+        self._count = count
+
+    def _invalid(self, line_no, error):
+        self.skipped += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line_no, str(error)))
+
+    def __len__(self):
+        # Counting takes one pass over the file; the result is kept
+        if self._count is None:
+            for _ in self:
+                pass
+        return self._count
+
+    def summary(self):
+        parts = [f"{len(self)} prompts"]
+        if self.duplicates:
+            parts.append(f"{self.duplicates} duplicates skipped")
+        if self.skipped:
+            parts.append(f"{self.skipped} invalid lines skipped")
+        return ", ".join(parts)
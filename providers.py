@@ -0,0 +1,373 @@
+# Text-to-image providers behind one interface
+# A provider wraps one API account: it submits a request in the canonical
+# (Stability-shaped) payload, downloads the resulting artifacts into files the
+# caller opens, and describes what it supports. A ProviderPool spreads requests
+# over several providers or API keys by weight, so a batch is no longer capped
+# by a single account's quota. Pools are configured with a JSON file:
+#
+#   [{"type": "stability", "api_key_file": "key1.txt", "weight": 2},
+#    {"type": "stability", "api_key": "sk-...", "rate_limit": 5},
+#    {"type": "deepai", "api_key_file": "deepai_key.txt"}]
+#
+# When a generation daemon (generation_daemon.py) is running, the front-ends
+# use a DaemonProvider instead, and the daemon's providers do the real work.
+
+import json
+import os
+import threading
+
+from api_client import ApiError, get_client, write_atomically
+from metrics import metrics
+from rate_limiter import RateLimiter, RetryBudgetExhausted, get_rate_limiter, transient_errors
+
+# The Stability text-to-image endpoint returns at most this many artifacts per request
+MAX_SAMPLES = 10
+
+STABILITY_HOST = os.getenv("API_HOST", "https://api.stability.ai")
+
+# Where the front-ends look for a generation daemon; empty to never use one
+DAEMON_URL = os.getenv("DSIMG_DAEMON_URL", "http://127.0.0.1:8766")
+DAEMON_PROBE_TIMEOUT = 0.5
+
+# Shared secret the daemon requires from the front-ends, readable only by its
+# user; keeps other local users and web pages from spending the API keys
+DAEMON_TOKEN_FILE = os.getenv(
+    "DSIMG_DAEMON_TOKEN_FILE", os.path.join(os.path.expanduser("~"), ".local", "share", "dsimg", "daemon_token"))
+
+# Statuses that mean this provider's account can't serve the request (bad or
+# revoked key, exhausted quota, server trouble), so another provider might.
+# Anything else, e.g. a 400 for a bad prompt, would fail the same everywhere.
+FAILOVER_STATUS = {401, 403, 429}
+
+
+def can_fail_over(error):
+    if isinstance(error, ApiError):
+        return error.status_code in FAILOVER_STATUS or error.status_code >= 500
+    return isinstance(error, transient_errors())
+
+
+# Daemon queue priorities, lowest runs first. Live previews go ahead of batch
+# work but, unlike interactive requests, never take the reserved worker, so
+# speculative previews cannot hold up an image the user asked for.
+PRIORITIES = {
+    "interactive": 0,
+    "preview": 5,
+    "batch": 10,
+}
+
+
+class Capabilities:
+    # sizes is a list of (width, height) the provider can produce, or None if
+    # it takes whatever the request asks for; rate_limit is in requests/sec
+    def __init__(self, max_samples=1, sizes=None, rate_limit=15.0, negative_prompts=True):
+        self.max_samples = max_samples
+        self.sizes = sizes
+        self.rate_limit = rate_limit
+        self.negative_prompts = negative_prompts
+
+    def accepts(self, payload):
+        if payload.get("samples", 1) > self.max_samples:
+            return False
+        size = (payload.get("width"), payload.get("height"))
+        return self.sizes is None or None in size or size in self.sizes
+
+
+class Provider:
+    name = "provider"
+    capabilities = Capabilities()
+
+    def __init__(self, weight=1.0, limiter=None, client=None, name=None):
+        self.weight = weight
+        self.limiter = limiter if limiter is not None else get_rate_limiter()
+        self.client = client if client is not None else get_client()
+        if name is not None:
+            self.name = name
+
+    def submit(self, engine_id, payload):
+        # Start a generation; returns whatever download() needs to fetch the result
+        raise NotImplementedError
+
+    def download(self, submission, open_artifact):
+        # Write artifact i into the file returned by open_artifact(i) (None
+        # discards it); returns the artifacts' metadata
+        raise NotImplementedError
+
+    def generate(self, engine_id, payload, open_artifact, budget=None, should_stop=None):
+        # Submit and download as one rate-limited, retried call. A retry calls
+        # open_artifact again for the same index, which must start the file over.
+        return self.limiter.call(
+            lambda: self.download(self.submit(engine_id, payload), open_artifact),
+            budget=budget, should_stop=should_stop)
+
+    def generate_file(self, engine_id, payload, filename, **kwargs):
+        # Single-image convenience for the interactive front-ends; returns the
+        # image's artifact metadata (e.g. its seed)
+        def write(f):
+            def open_artifact(index):
+                if index != 0:
+                    return None
+                f.seek(0)
+                f.truncate()
+                return f
+
+            artifacts = self.generate(engine_id, payload, open_artifact, **kwargs)
+            if not artifacts:
+                raise ApiError("Response contained no image", 200)
+            return artifacts[0]
+
+        return write_atomically(filename, write)
+
+
+class StabilityProvider(Provider):
+    name = "stability"
+    capabilities = Capabilities(max_samples=MAX_SAMPLES, rate_limit=15.0)
+
+    def __init__(self, api_key, api_host=None, **kwargs):
+        super().__init__(**kwargs)
+        self.api_key = api_key
+        self.api_host = api_host or STABILITY_HOST
+
+    def submit(self, engine_id, payload):
+        if not self.api_key:
+            raise Exception("Missing Stability API key.")
+        return self.client.stability_submit(self.api_host, self.api_key, engine_id, payload)
+
+    def download(self, response, open_artifact):
+        # Artifacts are decoded from the response stream as it arrives
+        return self.client.stability_receive(response, open_artifact).get("artifacts", [])
+
+
+class DeepAIProvider(Provider):
+    name = "deepai"
+    capabilities = Capabilities(max_samples=1, sizes=[(512, 512)], rate_limit=5.0)
+
+    def __init__(self, api_key, api_host=None, **kwargs):
+        super().__init__(**kwargs)
+        self.api_key = api_key
+        self.api_host = api_host
+
+    def submit(self, engine_id, payload):
+        # DeepAI has no engines or prompt weights: positive prompts become the
+        # text, negatively weighted ones the negative prompt
+        text = [p["text"] for p in payload["text_prompts"] if p.get("weight", 1.0) >= 0]
+        negative = [p["text"] for p in payload["text_prompts"] if p.get("weight", 1.0) < 0]
+        return self.client.deepai_text2img(self.api_key, ", ".join(text), ", ".join(negative), host=self.api_host)
+
+    def download(self, output_url, open_artifact):
+        f = open_artifact(0)
+        if f is not None:
+            self.client.download_to(output_url, f)
+        return [{"url": output_url}]
+
+
+PROVIDER_TYPES = {
+    "stability": StabilityProvider,
+    "deepai": DeepAIProvider,
+}
+
+
+class ProviderPool(Provider):
+    # Sends each request to the eligible provider with the lowest load relative
+    # to its weight. A request that fails on one provider (e.g. a revoked key or
+    # an exhausted quota) is tried on the others before it is given up.
+    name = "pool"
+
+    def __init__(self, providers):
+        if not providers:
+            raise ValueError("A provider pool needs at least one provider")
+        self.providers = list(providers)
+        self.weight = sum(provider.weight for provider in self.providers)
+        self.capabilities = self._combined_capabilities(self.providers)
+        self._in_flight = {id(provider): 0 for provider in self.providers}
+        self._assigned = dict(self._in_flight)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _combined_capabilities(providers):
+        # Only batch as many samples as every member accepts
+        sizes = None
+        if all(provider.capabilities.sizes is not None for provider in providers):
+            sizes = sorted({size for provider in providers for size in provider.capabilities.sizes})
+        return Capabilities(
+            max_samples=min(provider.capabilities.max_samples for provider in providers),
+            sizes=sizes,
+            rate_limit=sum(provider.capabilities.rate_limit for provider in providers),
+            negative_prompts=all(provider.capabilities.negative_prompts for provider in providers),
+        )
+
+    def select(self, payload, exclude=()):
+        with self._lock:
+            candidates = [provider for provider in self.providers
+                          if provider.capabilities.accepts(payload) and id(provider) not in exclude]
+            if not candidates:
+                return None
+            provider = min(candidates, key=lambda p: ((self._in_flight[id(p)] + 1) / p.weight,
+                                                      self._assigned[id(p)] / p.weight))
+            self._in_flight[id(provider)] += 1
+            self._assigned[id(provider)] += 1
+            return provider
+
+    def _release(self, provider):
+        with self._lock:
+            self._in_flight[id(provider)] -= 1
+
+    def submit(self, engine_id, payload):
+        provider = self.select(payload)
+        if provider is None:
+            raise ValueError("No provider accepts this request")
+        try:
+            return provider, provider.submit(engine_id, payload)
+        except BaseException:
+            self._release(provider)
+            raise
+
+    def download(self, submission, open_artifact):
+        provider, inner = submission
+        try:
+            return provider.download(inner, open_artifact)
+        finally:
+            self._release(provider)
+
+    def generate(self, engine_id, payload, open_artifact, budget=None, should_stop=None):
+        tried = set()
+        while True:
+            provider = self.select(payload, exclude=tried)
+            if provider is None:
+                raise ValueError("No provider accepts this request")
+            tried.add(id(provider))
+            metrics.incr(f"requests_{provider.name}")
+            try:
+                return provider.generate(engine_id, payload, open_artifact, budget=budget, should_stop=should_stop)
+            except RetryBudgetExhausted:
+                raise
+            except Exception as e:
+                failover = can_fail_over(e) and (should_stop is None or not should_stop()) and any(
+                    id(p) not in tried and p.capabilities.accepts(payload) for p in self.providers)
+                if not failover:
+                    raise
+                metrics.incr("failovers")
+            finally:
+                self._release(provider)
+
+
+class DaemonProvider(Provider):
+    # Thin client of a generation daemon. The daemon holds the API keys,
+    # connection pool, rate limiter and cache and answers in the Stability
+    # response format whatever its provider is. priority picks the daemon
+    # queue; provider_type which of the daemon's providers runs the request.
+    name = "daemon"
+
+    def __init__(self, url, capabilities, priority="batch", provider_type="stability", token=None, **kwargs):
+        # Rate limiting and retries happen in the daemon, so an error status
+        # means its retries are spent; here only a dropped connection is retried
+        kwargs.setdefault("limiter", RateLimiter(
+            rate=1e6, burst=1e6, initial_concurrency=64, max_concurrency=64, max_attempts=2, retry_status=()))
+        super().__init__(**kwargs)
+        self.url = url
+        self.capabilities = capabilities
+        self.priority = priority
+        self.provider_type = provider_type
+        self.token = token
+
+    def submit(self, engine_id, payload):
+        # The token goes where the API key would, as a bearer token
+        return self.client.stability_submit(
+            self.url, self.token, engine_id or self.provider_type, payload,
+            headers={"X-Priority": self.priority, "X-Provider": self.provider_type})
+
+    def download(self, response, open_artifact):
+        return self.client.stability_receive(response, open_artifact).get("artifacts", [])
+
+
+def capabilities_to_json(capabilities):
+    return {
+        "max_samples": capabilities.max_samples,
+        "sizes": capabilities.sizes,
+        "rate_limit": capabilities.rate_limit,
+        "negative_prompts": capabilities.negative_prompts,
+    }
+
+
+def capabilities_from_json(data):
+    sizes = data.get("sizes")
+    return Capabilities(
+        max_samples=int(data.get("max_samples", 1)),
+        sizes=None if sizes is None else [tuple(size) for size in sizes],
+        rate_limit=float(data.get("rate_limit", 15.0)),
+        negative_prompts=bool(data.get("negative_prompts", True)),
+    )
+
+
+def read_daemon_token(path=DAEMON_TOKEN_FILE):
+    # The daemon's token, or None if there is none (yet)
+    try:
+        with open(path, "r") as f:
+            return f.readline().strip() or None
+    except OSError:
+        return None
+
+
+def connect_daemon(priority="batch", provider_type="stability", url=DAEMON_URL, client=None, token=None):
+    # A DaemonProvider if a daemon is listening at url, accepts our token and
+    # has a provider of this type, else None (the caller then talks to the API itself)
+    token = token if token is not None else read_daemon_token()
+    if not url or token is None:
+        return None
+    client = client if client is not None else get_client()
+    try:
+        response = client.get(f"{url}/status", timeout=DAEMON_PROBE_TIMEOUT,
+                              headers={"Authorization": f"Bearer {token}"})
+        status = response.json() if response.status_code == 200 else {}
+    except (ValueError,) + transient_errors():
+        return None
+    capabilities = status.get("providers", {}).get(provider_type)
+    if capabilities is None:
+        return None
+    return DaemonProvider(url, capabilities_from_json(capabilities), priority, provider_type, token, client=client)
+
+
+def provider_from_config(entry, client=None):
+    # entry: {"type", "api_key" or "api_key_file", "api_host", "weight",
+    # "rate_limit", "burst", "max_concurrency", "name"}. Every entry gets its
+    # own rate limiter, since each key has its own quota.
+    cls = PROVIDER_TYPES.get(entry.get("type", "stability"))
+    if cls is None:
+        raise ValueError(f"Unknown provider type: {entry.get('type')}")
+    api_key = entry.get("api_key")
+    if api_key is None and "api_key_file" in entry:
+        with open(entry["api_key_file"], "r") as f:
+            api_key = f.readline().strip()
+    rate = float(entry.get("rate_limit", cls.capabilities.rate_limit))
+    limiter = RateLimiter(
+        rate=rate,
+        burst=entry.get("burst", max(1, rate)),
+        max_concurrency=int(entry.get("max_concurrency", 32)),
+    )
+    return cls(
+        api_key,
+        api_host=entry.get("api_host"),
+        weight=float(entry.get("weight", 1.0)),
+        limiter=limiter,
+        client=client,
+        name=entry.get("name"),
+    )
+
+
+def read_provider_config(path):
+    # A JSON list of provider entries, or {"providers": [...]}
+    with open(path, "r") as f:
+        config = json.load(f)
+    if isinstance(config, dict):
+        config = config.get("providers", [])
+    return config
+
+
+def pool_of(providers):
+    # A single provider as is, several as a ProviderPool
+    if len(providers) == 1:
+        return providers[0]
+    return ProviderPool(providers)
+
+
+def load_providers(path, client=None):
+    return pool_of([provider_from_config(entry, client) for entry in read_provider_config(path)])
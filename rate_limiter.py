@@ -0,0 +1,195 @@
+# Client-side rate limiting and retries for the generation APIs
+# A token bucket caps the request rate, an AIMD limit adapts the number of
+# requests in flight to what the API sustains, and failed calls are retried
+# with jittered exponential backoff that honors Retry-After.
+
+import os
+import random
+import threading
+import time
+
+from api_client import ApiError
+from metrics import metrics
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class RetryBudgetExhausted(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        # Stop handing out tokens, e.g. after the API asked us to back off
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    # Additive increase on success, multiplicative decrease when throttled
+    def __init__(self, initial=4, minimum=1, maximum=32, decrease_interval=1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_interval = decrease_interval
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                # A burst of 429s from one overload only halves the limit once
+                if now - self._last_decrease >= self.decrease_interval:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class RetryBudget:
+    # Retries allowed for one job: a fixed floor plus a fraction of the
+    # requests made, so a failing API cannot multiply the load
+    def __init__(self, ratio=0.2, minimum=10):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.requests = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def try_spend(self):
+        with self._lock:
+            if self.retries >= self.minimum + self.ratio * self.requests:
+                return False
+            self.retries += 1
+            return True
+
+
+def transient_errors():
+    # Evaluated only when an exception is being matched, so requests is never
+    # imported just for this module
+    import requests
+    return requests.Timeout, requests.ConnectionError
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    # Full jitter: spreads retries from many workers instead of synchronizing them
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def _sleep(seconds, should_stop):
+    deadline = time.monotonic() + seconds
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or (should_stop is not None and should_stop()):
+            return
+        time.sleep(min(remaining, 0.25))
+
+
+class RateLimiter:
+    def __init__(self, rate=15.0, burst=15, initial_concurrency=4, max_concurrency=32,
+                 max_attempts=5, base_delay=1.0, max_delay=60.0, retry_status=RETRYABLE_STATUS):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = AdaptiveConcurrency(initial_concurrency, maximum=max_concurrency)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # HTTP statuses worth another attempt; connection errors always are
+        self.retry_status = retry_status
+        self.retries = 0
+
+    def call(self, fn, budget=None, should_stop=None):
+        attempt = 0
+        while True:
+            self.concurrency.acquire()
+            self.bucket.acquire()
+            if budget is not None:
+                budget.record_request()
+
+            throttled = False
+            try:
+                return fn()
+            except ApiError as e:
+                if e.status_code not in self.retry_status:
+                    raise
+                error = e
+                throttled = e.status_code == 429
+                retry_after = e.retry_after
+                if throttled:
+                    metrics.incr("throttled")
+            except transient_errors() as e:
+                error = e
+                retry_after = None
+            finally:
+                self.concurrency.release(throttled)
+
+            attempt += 1
+            if attempt >= self.max_attempts:
+                raise error
+            if budget is not None and not budget.try_spend():
+                raise RetryBudgetExhausted(f"Retry budget exhausted: {error}")
+            if should_stop is not None and should_stop():
+                raise error
+
+            delay = backoff_delay(attempt, self.base_delay, self.max_delay)
+            if retry_after is not None:
+                # The server's Retry-After applies to the whole key, not just this call
+                self.bucket.pause(retry_after)
+                delay = max(delay, retry_after)
+            self.retries += 1
+            metrics.incr("retries")
+            with metrics.span("backoff"):
+                _sleep(delay, should_stop)
+            # A stop during the backoff cuts the sleep short; don't retry after it
+            if should_stop is not None and should_stop():
+                raise error
+
+
+_shared_limiter = None
+_shared_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    # Process-wide limiter so every front-end and worker shares one view of the API's limits
+    global _shared_limiter
+    with _shared_limiter_lock:
+        if _shared_limiter is None:
+            _shared_limiter = RateLimiter(
+                rate=float(os.getenv("API_RATE_LIMIT", "15")),
+                burst=int(os.getenv("API_RATE_BURST", "15")),
+                max_concurrency=int(os.getenv("API_MAX_CONCURRENCY", "32")),
+            )
+    return _shared_limiter
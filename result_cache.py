@@ -0,0 +1,145 @@
+# Content-addressed on-disk cache of generated images
+# Entries are keyed by a hash of the normalized generation request, so
+# re-running a prompt file with the same settings costs no API calls.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from metrics import metrics
+
+DEFAULT_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "dsimg"))
+DEFAULT_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_MB", "2048")) * 1024 * 1024
+
+# Request fields that change the image the API returns
+KEY_FIELDS = (
+    "text_prompts",
+    "cfg_scale",
+    "clip_guidance_preset",
+    "style_preset",
+    "width",
+    "height",
+    "seed",
+    "steps",
+    "sampler",
+)
+
+
+def make_key(engine_id, payload, variant=None):
+    # Without a seed the API picks a random one, so identical requests are only
+    # interchangeable per variant (e.g. the iteration number of a batch run)
+    normalized = {"engine_id": engine_id}
+    for field in KEY_FIELDS:
+        if payload.get(field) is not None:
+            normalized[field] = payload[field]
+    normalized["text_prompts"] = [
+        {"text": p["text"].strip(), "weight": float(p.get("weight", 1.0))}
+        for p in payload.get("text_prompts", [])
+    ]
+    if not payload.get("seed") and variant is not None:
+        normalized["variant"] = variant
+
+    encoded = json.dumps(normalized, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+
+        # key -> size, least recently used first
+        self._entries = OrderedDict()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        # Rebuild the LRU order from file modification times, which get bumped on every hit
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith(".png"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self.total_bytes += size
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key + ".png")
+
+    def lookup(self, key):
+        # Returns the path of the cached image, or None
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                metrics.incr("cache_misses")
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        metrics.incr("cache_hits")
+
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Removed behind our back; treat as a miss
+            with self._lock:
+                self.hits -= 1
+                self.misses += 1
+                self.total_bytes -= self._entries.pop(key, 0)
+            metrics.incr("cache_hits", -1)
+            metrics.incr("cache_misses")
+            return None
+        return path
+
+    def __contains__(self, key):
+        # Peeks without counting a hit or miss or bumping the entry
+        with self._lock:
+            return key in self._entries
+
+    def copy_to(self, key, filename):
+        # Copy a cached image to filename; False on a miss
+        path = self.lookup(key)
+        if path is None:
+            return False
+        try:
+            shutil.copyfile(path, filename)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put_file(self, key, filename):
+        path = self.path_for(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".part")
+        os.close(fd)
+        shutil.copyfile(filename, tmp_path)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+
+        with self._lock:
+            self.total_bytes -= self._entries.pop(key, 0)
+            self._entries[key] = size
+            self.total_bytes += size
+            self._evict()
+
+    def _evict(self):
+        # Drop least recently used entries until the cache fits its budget
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.path_for(key))
+            except FileNotFoundError:
+                pass
+
+    def stats_text(self):
+        return f"Cache: {self.hits} hits / {self.misses} misses"
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# Long-run memory check for the batch generation path
+# Drives BatchEngine against an in-process mock API (see mock_server.py) for
+# a fixed time, samples the process RSS as it goes and fits a line through
+# the samples after a warm-up. A pipeline that holds on to finished work
+# shows up as a steady slope; a bounded one levels off. Finished images are
+# deleted as the run goes so the disk does not fill up, and the in-memory
+# trace buffer (bounded, but ~35 MiB when full) is kept small so that its
+# filling up is not mistaken for growth:
+#
+#   python soak.py --duration 3h --concurrency 16 --latency 0.2
+#   python soak.py --duration 20m --gallery --catalog --max-growth-mb-per-hour 16
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+
+from api_client import ApiClient
+from batch_engine import DEFAULT_ENGINE_ID, DEFAULT_STYLE_PRESET, BatchEngine, read_prompt_list
+from metrics import metrics
+from mock_server import MockApiServer, add_config_arguments, config_from_args
+from pipeline_limits import DEFAULT_MAX_INFLIGHT_BYTES, PipelineLimits
+from rate_limiter import RateLimiter
+
+# Enough iterations that the run is always ended by the clock
+ITERATIONS = 10 ** 9
+
+# Trace events kept in memory during a soak
+SOAK_TRACE_EVENTS = 5000
+
+# Finished images kept on disk (for the gallery and catalog to read) before deletion
+KEEP_FILES = 500
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(text):
+    # "90", "90s", "20m" or "3h" -> seconds
+    unit = DURATION_UNITS.get(text[-1:].lower())
+    if unit is None:
+        return float(text)
+    return float(text[:-1]) * unit
+
+
+def current_rss_mb():
+    # Resident set size now, from /proc; the peak where /proc is missing
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except OSError:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def growth_per_hour(samples):
+    # Least-squares slope of [(seconds, MiB), ...] in MiB per hour
+    if len(samples) < 2:
+        return 0.0
+    mean_t = sum(t for t, _ in samples) / len(samples)
+    mean_rss = sum(rss for _, rss in samples) / len(samples)
+    variance = sum((t - mean_t) ** 2 for t, _ in samples)
+    if not variance:
+        return 0.0
+    covariance = sum((t - mean_t) * (rss - mean_rss) for t, rss in samples)
+    return covariance / variance * 3600
+
+
+def run_soak(duration, prompts, concurrency, samples_per_request, mock_config, limits, sample_interval=10.0,
+             warmup=None, gallery=False, catalog=False, api_host=None):
+    server = None
+    if api_host is None:
+        server = MockApiServer(config=mock_config).start()
+        api_host = server.url
+    if warmup is None:
+        warmup = duration / 5
+
+    samples = []
+    produced = 0
+    recent = deque()
+
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            prompt_file = os.path.join(work_dir, "prompts.txt")
+            with open(prompt_file, "w") as f:
+                for i in range(prompts):
+                    f.write(f"soak prompt {i}\n")
+            output_dir = os.path.join(work_dir, "out")
+            os.makedirs(output_dir)
+
+            image_catalog = None
+            if catalog:
+                from catalog import Catalog
+
+                image_catalog = Catalog(os.path.join(work_dir, "catalog.sqlite"))
+
+            # No cache and an effectively unlimited rate limit, as in benchmark.py
+            engine = BatchEngine(
+                api_host, "mock", DEFAULT_ENGINE_ID, DEFAULT_STYLE_PRESET, 7, 512, 512, output_dir,
+                concurrency=concurrency,
+                client=ApiClient(pool_size=concurrency),
+                limiter=RateLimiter(rate=1e6, burst=1e6, initial_concurrency=concurrency,
+                                    max_concurrency=concurrency),
+                samples_per_request=samples_per_request,
+                catalog=image_catalog,
+                limits=limits,
+            )
+            metrics.reset(trace_events=SOAK_TRACE_EVENTS)
+            prompt_list = read_prompt_list(prompt_file, 512, 512)
+            start = time.monotonic()
+
+            def out_of_time():
+                return time.monotonic() - start >= duration
+
+            def retire(path):
+                nonlocal produced
+                produced += 1
+                recent.append(path)
+                if len(recent) > KEEP_FILES:
+                    try:
+                        os.remove(recent.popleft())
+                    except OSError:
+                        pass
+
+            def sample():
+                samples.append((time.monotonic() - start, current_rss_mb()))
+
+            if gallery:
+                run_with_gallery(engine, prompt_list, out_of_time, retire, sample, sample_interval)
+            else:
+                thread = threading.Thread(
+                    target=engine.run, args=(prompt_list, ITERATIONS),
+                    kwargs={"on_result": lambda prompt, path: retire(path), "should_stop": out_of_time})
+                thread.start()
+                sample()
+                while thread.is_alive():
+                    thread.join(sample_interval)
+                    sample()
+            elapsed = time.monotonic() - start
+            if image_catalog is not None:
+                image_catalog.flush()
+    finally:
+        if server is not None:
+            stats = server.snapshot()
+            server.stop()
+        else:
+            stats = {}
+
+    warm = [(t, rss) for t, rss in samples if t >= warmup]
+    return {
+        "images": produced,
+        "failed": engine.failed,
+        "elapsed": elapsed,
+        "images_per_sec": produced / elapsed if elapsed else 0.0,
+        "rss_start_mb": samples[0][1],
+        "rss_after_warmup_mb": warm[0][1] if warm else samples[-1][1],
+        "rss_end_mb": samples[-1][1],
+        "rss_max_mb": max(rss for _, rss in samples),
+        "growth_mb_per_hour": growth_per_hour(warm),
+        "samples": samples,
+        "gauges": dict(metrics.gauges),
+        "counters": dict(metrics.counters),
+        "server": stats,
+    }
+
+
+def run_with_gallery(engine, prompt_list, out_of_time, retire, sample, sample_interval):
+    # Feeds an (offscreen) gallery through a job, as batchQtDSimg2 does
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from qtpy import QtCore, QtWidgets
+
+    from job_runner import JobRunner
+    from thumbnail_gallery import ThumbnailGallery
+
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    gallery = ThumbnailGallery()
+    gallery.resize(1200, 900)
+    gallery.show()
+
+    def run_batch(job):
+        engine.run(prompt_list, ITERATIONS, should_stop=lambda: job.is_cancelled() or out_of_time(),
+                   on_result=lambda prompt, path: job.emit_result((prompt["text"], path)))
+
+    def show_image(result):
+        prompt_text, path = result
+        gallery.add_image(path, prompt_text)
+        retire(path)
+
+    runner = JobRunner()
+    job = runner.submit(run_batch)
+    job.signals.result.connect(show_image)
+    job.signals.error.connect(lambda message: print(f"soak run failed: {message}", file=sys.stderr))
+    job.signals.finished.connect(app.quit)
+    timer = QtCore.QTimer()
+    timer.setInterval(int(sample_interval * 1000))
+    timer.timeout.connect(sample)
+    timer.start()
+    sample()
+    app.exec_()
+    timer.stop()
+    runner.shutdown()
+    sample()
+
+
+def format_report(report):
+    lines = [
+        f"images:        {report['images']} ({report['failed']} failed) in {report['elapsed']:.0f}s",
+        f"throughput:    {report['images_per_sec']:.2f} images/sec",
+        f"RSS:           start {report['rss_start_mb']:.1f} MiB  after warm-up {report['rss_after_warmup_mb']:.1f} MiB  "
+        f"end {report['rss_end_mb']:.1f} MiB  max {report['rss_max_mb']:.1f} MiB",
+        f"growth:        {report['growth_mb_per_hour']:+.2f} MiB/hour after warm-up",
+        f"gauges:        {report['gauges']}",
+        f"counters:      {report['counters']}",
+    ]
+    if report["server"]:
+        lines.append(f"server:        {report['server']}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that batch generation runs in flat memory")
+    parser.add_argument("--duration", type=parse_duration, default=600.0, help="run time, e.g. 600, 20m or 3h")
+    parser.add_argument("--warmup", type=parse_duration,
+                        help="samples before this are left out of the fit (default: the first fifth)")
+    parser.add_argument("--sample-interval", type=parse_duration, default=10.0, help="seconds between RSS samples")
+    parser.add_argument("--prompts", type=int, default=50, help="distinct prompts in the generated prompt file")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--samples-per-request", type=int, default=1)
+    parser.add_argument("--max-inflight-mb", type=int, default=DEFAULT_MAX_INFLIGHT_BYTES // (1024 * 1024))
+    parser.add_argument("--gallery", action="store_true", help="also feed an offscreen thumbnail gallery")
+    parser.add_argument("--catalog", action="store_true", help="also record images in a scratch catalog")
+    parser.add_argument("--api-host", help="soak an already running (mock) server instead")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--max-growth-mb-per-hour", type=float,
+                        help="exit non-zero if RSS grows faster than this after warm-up")
+    add_config_arguments(parser)
+    args = parser.parse_args(argv)
+
+    report = run_soak(
+        args.duration, args.prompts, args.concurrency, args.samples_per_request, config_from_args(args),
+        PipelineLimits(max_inflight_bytes=args.max_inflight_mb * 1024 * 1024),
+        sample_interval=args.sample_interval, warmup=args.warmup, gallery=args.gallery,
+        catalog=args.catalog, api_host=args.api_host)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+
+    failures = []
+    if args.max_growth_mb_per_hour is not None and report["growth_mb_per_hour"] > args.max_growth_mb_per_hour:
+        failures.append(f"RSS growth {report['growth_mb_per_hour']:.2f} MiB/hour > {args.max_growth_mb_per_hour}")
+    if report["failed"]:
+        failures.append(f"{report['failed']} images failed")
+    for failure in failures:
+        print(f"REGRESSION: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# Startup benchmark for the Qt front-ends
+# Starts each app in a fresh interpreter and reports how long its imports take
+# (as measured by python -X importtime), how long the window takes to build,
+# and the time from process start to the window's first paint. It also lists
+# any heavy modules (HTTP client, image codecs, database) that were loaded
+# before the first paint; those belong behind the first generate. Thresholds
+# turn it into a regression check:
+#
+#   python startup_benchmark.py --runs 5
+#   python startup_benchmark.py batch --max-first-paint-ms 400 --max-import-ms 150
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# name -> (module, window class)
+APPS = {
+    "batch": ("batchQtDSimg2", "TextToImageApp"),
+    "dsimg": ("QtDSimg", "TextToImageApp"),
+    "text2img": ("QtText2Img", "Text2ImgGUI"),
+}
+
+# Modules that should not be loaded until something is generated
+HEAVY_MODULES = ["requests", "urllib3", "PIL", "sqlite3", "batch_engine", "catalog", "result_cache"]
+
+
+def run_child(app_name):
+    # Runs in the measured process: import, build and show the window, and
+    # report once it has painted
+    start = time.perf_counter()
+    module_name, class_name = APPS[app_name]
+    module = __import__(module_name)
+    imported = time.perf_counter()
+
+    from qtpy import QtCore, QtWidgets
+
+    app = QtWidgets.QApplication([])
+    window = getattr(module, class_name)()
+    constructed = time.perf_counter()
+    report = {}
+
+    class PaintFilter(QtCore.QObject):
+        def eventFilter(self, obj, event):
+            if event.type() == QtCore.QEvent.Paint and not report:
+                report.update({
+                    "first_paint_time": time.time(),
+                    "import_ms": (imported - start) * 1000,
+                    "construct_ms": (constructed - imported) * 1000,
+                    "paint_ms": (time.perf_counter() - constructed) * 1000,
+                    "heavy_modules": [name for name in HEAVY_MODULES if name in sys.modules],
+                })
+                QtCore.QTimer.singleShot(0, app.quit)
+            return False
+
+    paint_filter = PaintFilter()
+    window.installEventFilter(paint_filter)
+    window.show()
+    # Offscreen platforms may never paint; give up rather than hang
+    QtCore.QTimer.singleShot(10000, app.quit)
+    app.exec_()
+    window.close()
+    print(json.dumps(report))
+    return 0 if report else 1
+
+
+def import_time_ms(module_name):
+    # Cumulative import time of module_name in a fresh interpreter
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+        cwd=HERE, capture_output=True, text=True)
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module_name and not fields[2][1:].startswith(" "):
+            return int(fields[1]) / 1000
+    raise RuntimeError(f"importing {module_name} failed:\n{result.stderr}")
+
+
+def measure(app_name, env):
+    started = time.time()
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", app_name],
+        cwd=HERE, env=env, capture_output=True, text=True)
+    lines = result.stdout.strip().splitlines()
+    if result.returncode or not lines:
+        raise RuntimeError(f"{app_name} did not paint:\n{result.stderr}")
+    report = json.loads(lines[-1])
+    report["first_paint_ms"] = (report.pop("first_paint_time") - started) * 1000
+    return report
+
+
+def run_benchmark(app_names, runs, platform="offscreen"):
+    env = dict(os.environ)
+    if platform:
+        env["QT_QPA_PLATFORM"] = platform
+    reports = {}
+    for app_name in app_names:
+        module_name = APPS[app_name][0]
+        # One unmeasured start so every run sees compiled bytecode
+        measure(app_name, env)
+        samples = [measure(app_name, env) for _ in range(runs)]
+        reports[app_name] = {
+            "importtime_ms": statistics.median(import_time_ms(module_name) for _ in range(runs)),
+            "import_ms": statistics.median(s["import_ms"] for s in samples),
+            "construct_ms": statistics.median(s["construct_ms"] for s in samples),
+            "first_paint_ms": statistics.median(s["first_paint_ms"] for s in samples),
+            "heavy_modules": sorted({name for s in samples for name in s["heavy_modules"]}),
+        }
+    return reports
+
+
+def format_report(reports):
+    lines = [f"{'app':<10} {'importtime':>11} {'import':>9} {'construct':>10} {'first paint':>12}  heavy modules"]
+    for app_name, report in reports.items():
+        lines.append(
+            f"{app_name:<10} {report['importtime_ms']:>9.1f}ms {report['import_ms']:>7.1f}ms "
+            f"{report['construct_ms']:>8.1f}ms {report['first_paint_ms']:>10.1f}ms  "
+            f"{', '.join(report['heavy_modules']) or '-'}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure import time and time to first paint of the Qt apps")
+    parser.add_argument("apps", nargs="*", help=f"apps to measure: {', '.join(APPS)} (default: all)")
+    parser.add_argument("--runs", type=int, default=3, help="starts per app; medians are reported")
+    parser.add_argument("--platform", default="offscreen",
+                        help="QT_QPA_PLATFORM for the measured apps ('' keeps the environment's)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--max-first-paint-ms", type=float, help="exit non-zero above this time to first paint")
+    parser.add_argument("--max-import-ms", type=float, help="exit non-zero above this import time")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        return run_child(args.child)
+    unknown = [name for name in args.apps if name not in APPS]
+    if unknown:
+        parser.error(f"unknown app: {', '.join(unknown)}")
+
+    reports = run_benchmark(args.apps or list(APPS), max(1, args.runs), args.platform)
+    print(json.dumps(reports, indent=2) if args.json else format_report(reports))
+
+    failures = []
+    for app_name, report in reports.items():
+        if args.max_first_paint_ms is not None and report["first_paint_ms"] > args.max_first_paint_ms:
+            failures.append(f"{app_name}: first paint {report['first_paint_ms']:.0f}ms > {args.max_first_paint_ms}ms")
+        if args.max_import_ms is not None and report["importtime_ms"] > args.max_import_ms:
+            failures.append(f"{app_name}: import {report['importtime_ms']:.0f}ms > {args.max_import_ms}ms")
+        if report["heavy_modules"]:
+            failures.append(f"{app_name}: loaded {', '.join(report['heavy_modules'])} before the first paint")
+    for failure in failures:
+        print(f"REGRESSION: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+# Incremental decoder for Stability text-to-image JSON responses
+# Artifacts arrive as large base64 strings inside a JSON document. Instead of
+# parsing the whole body and decoding each image in memory, the decoder scans
+# the stream, base64-decodes artifact data chunk by chunk straight into files,
+# and keeps only the small remainder of the JSON (seed, finishReason, ...).
+
+import base64
+import binascii
+import json
+import time
+
+BASE64_KEY = b'"base64"'
+
+
+class StreamDecodeError(Exception):
+    pass
+
+
+class ArtifactStreamDecoder:
+    # open_artifact(index) returns a writable binary file for the index-th
+    # artifact, or None to discard its data
+    def __init__(self, open_artifact):
+        self.open_artifact = open_artifact
+        self.artifact_count = 0
+        self.bytes_written = 0
+        self.write_seconds = 0.0
+
+        self._skeleton = bytearray()
+        self._scan_from = 0
+        self._in_base64 = False
+        self._file = None
+        self._carry = b""
+
+    def feed(self, chunk):
+        while chunk:
+            if self._in_base64:
+                chunk = self._feed_base64(chunk)
+            else:
+                chunk = self._feed_json(chunk)
+
+    def _feed_json(self, chunk):
+        # Outside artifact data: keep the bytes and look for the next "base64" value
+        self._skeleton += chunk
+        key = self._skeleton.find(BASE64_KEY, self._scan_from)
+        if key == -1:
+            self._scan_from = max(0, len(self._skeleton) - len(BASE64_KEY))
+            return b""
+
+        # Skip whitespace and the colon up to the opening quote of the value
+        pos = key + len(BASE64_KEY)
+        while pos < len(self._skeleton) and self._skeleton[pos] in b" \t\r\n:":
+            pos += 1
+        if pos >= len(self._skeleton):
+            # Value hasn't arrived yet
+            self._scan_from = key
+            return b""
+        if self._skeleton[pos:pos + 1] != b'"':
+            raise StreamDecodeError("Expected a string value for base64")
+
+        rest = bytes(self._skeleton[pos + 1:])
+        del self._skeleton[pos + 1:]
+        self._scan_from = len(self._skeleton)
+        self._in_base64 = True
+        self._file = self.open_artifact(self.artifact_count)
+        return rest
+
+    def _feed_base64(self, chunk):
+        end = chunk.find(b'"')
+        data = chunk if end == -1 else chunk[:end]
+        self._write_base64(data, final=end != -1)
+        if end == -1:
+            return b""
+
+        # Closing quote: the value is replaced by "" in the skeleton
+        self._skeleton += b'"'
+        self._scan_from = len(self._skeleton)
+        self._in_base64 = False
+        self._file = None
+        self.artifact_count += 1
+        return chunk[end + 1:]
+
+    def _write_base64(self, data, final):
+        data = self._carry + data
+        # JSON may escape "/" as "\/"; hold back a trailing backslash until its pair arrives
+        if data.endswith(b"\\") and not final:
+            self._carry = b"\\"
+            data = data[:-1]
+        else:
+            self._carry = b""
+        if b"\\" in data:
+            data = data.replace(b"\\/", b"/").replace(b"\\n", b"").replace(b"\\r", b"")
+
+        # Decode whole 4-character groups now, the rest once more data arrives
+        usable = len(data) if final else len(data) - len(data) % 4
+        if not final:
+            self._carry = data[usable:] + self._carry
+        try:
+            decoded = base64.b64decode(data[:usable])
+        except binascii.Error as e:
+            raise StreamDecodeError(f"Invalid base64 in artifact {self.artifact_count}: {e}")
+        if self._file is not None:
+            start = time.perf_counter()
+            self._file.write(decoded)
+            self.write_seconds += time.perf_counter() - start
+            self.bytes_written += len(decoded)
+
+    def finish(self):
+        # Returns the parsed response with every artifact's base64 value emptied
+        if self._in_base64:
+            raise StreamDecodeError("Response ended inside artifact data")
+        try:
+            return json.loads(bytes(self._skeleton))
+        except ValueError as e:
+            raise StreamDecodeError(f"Invalid JSON response: {e}")
@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+# Parameter sweeps over prompts x style presets x engines x cfg scales x seeds
+# The cross product is planned up front as one list of requests: identical
+# requests (e.g. overlapping cfg ranges, or a prompt listed twice under
+# different filenames) are sent once, and the requests are ordered engine by
+# engine so each engine's work runs together. Swept values win over the
+# prompt file's own overrides; axes left out keep them. The plan's size, cost and duration estimates are
+# printed before anything is sent; the sweep then runs through BatchEngine's
+# concurrent pipeline and is laid out as a comparison grid (index.html, one
+# table per prompt) in the output directory:
+#
+#   python sweep.py prompts.txt --engines stable-diffusion-v1-5,stable-diffusion-512-v2-1 \
+#       --styles enhance,anime --cfg-scale 5:13:2 --seeds 1,2 --output-dir sweep
+
+import argparse
+import html
+import json
+import math
+import os
+import sys
+import time
+
+from api_client import get_client
+from batch_engine import BatchEngine, is_seeded, read_prompt_list
+from catalog import Catalog
+from generation_settings import (
+    DEFAULT_ENGINE_ID,
+    DEFAULT_STYLE_PRESET,
+    ENGINE_IDS,
+    STYLE_PRESETS,
+    default_size,
+    read_api_key,
+)
+from metrics import metrics
+from prompt_source import MAX_SEED
+from providers import load_providers
+from result_cache import ResultCache
+
+# Assumed time per request for engines the catalog has no timings for
+DEFAULT_REQUEST_SECONDS = 8.0
+
+# Rough DreamStudio price of one 512x512 image at the default steps; larger
+# images are charged by area
+DEFAULT_CREDITS_PER_IMAGE = 0.2
+BASE_PIXELS = 512 * 512
+
+# Prompt part of sweep filenames, so the axis values still fit in a name
+MAX_STEM_CHARS = 80
+
+GRID_THUMBNAIL_SIZE = 256
+MANIFEST_FILE = "sweep.json"
+GRID_FILE = "index.html"
+
+
+def parse_values(text, convert=float):
+    # "5,7,9" or an inclusive range "5:13:2" (step defaults to 1), or a mix
+    values = []
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if ":" not in part:
+            values.append(convert(part))
+            continue
+        fields = [convert(field) for field in part.split(":")]
+        if len(fields) not in (2, 3):
+            raise ValueError(f"expected start:stop[:step], got {part!r}")
+        start, stop = fields[:2]
+        step = fields[2] if len(fields) == 3 else 1
+        if step <= 0:
+            raise ValueError(f"step must be positive in {part!r}")
+        count = int(math.floor((stop - start) / step + 1e-9)) + 1
+        values.extend(convert(round(start + i * step, 6)) for i in range(count))
+    return values
+
+
+def parse_choices(text, choices, name):
+    values = [value.strip() for value in text.split(",") if value.strip()]
+    unknown = [value for value in values if value not in choices]
+    if unknown:
+        raise ValueError(f"unknown {name}: {', '.join(unknown)}")
+    return values
+
+
+def sweep_filename(prompt, engine_id, style_preset, cfg_scale, seed):
+    stem = os.path.splitext(prompt["filename"])[0][:MAX_STEM_CHARS]
+    seed_label = "random" if seed is None else seed
+    return f"{stem}__{engine_id}__{style_preset}__cfg{cfg_scale:g}__seed{seed_label}.png"
+
+
+class SweepPlan:
+    # requests: the prompt dicts to generate, unique and grouped by engine.
+    # cells: one per point of the cross product, as (prompt index, engine_id,
+    # style_preset, cfg_scale, seed, request key); duplicate cells share a key.
+    def __init__(self, engine, prompts, engine_ids, style_presets, cfg_scales=(None,), seeds=(None,)):
+        self.prompts = list(prompts)
+        self.engine_ids = list(engine_ids)
+        self.style_presets = list(style_presets)
+        self.cfg_scales = list(cfg_scales) or [None]
+        self.seeds = list(seeds) or [None]
+        self.requests = []
+        self.cells = []
+        self.duplicates = 0
+
+        seen = set()
+        for engine_id in self.engine_ids:
+            width, height = default_size(engine_id)
+            for style_preset in self.style_presets:
+                for index, prompt in enumerate(self.prompts):
+                    for cfg_scale in self.cfg_scales:
+                        for seed in self.seeds:
+                            request = dict(prompt, engine_id=engine_id, style_preset=style_preset,
+                                           width=width, height=height)
+                            if cfg_scale is not None:
+                                request["cfg_scale"] = cfg_scale
+                            if seed is not None:
+                                request["seed"] = seed
+                            # The values the request really uses, after prompt file overrides
+                            payload = engine.build_payload(request)
+                            request["filename"] = sweep_filename(
+                                prompt, engine_id, style_preset, payload["cfg_scale"], payload.get("seed"))
+                            key = engine.request_key(request, 0)
+                            self.cells.append(
+                                (index, engine_id, style_preset, payload["cfg_scale"], payload.get("seed"), key))
+                            if key in seen:
+                                self.duplicates += 1
+                                continue
+                            seen.add(key)
+                            self.requests.append(request)
+
+    def describe(self):
+        axes = [f"{len(self.prompts)} prompts", f"{len(self.engine_ids)} engines",
+                f"{len(self.style_presets)} styles"]
+        if self.cfg_scales != [None]:
+            axes.append(f"{len(self.cfg_scales)} cfg scales")
+        if self.seeds != [None]:
+            axes.append(f"{len(self.seeds)} seeds")
+        return f"{' x '.join(axes)} = {len(self.cells)} cells, " \
+               f"{len(self.requests)} requests ({self.duplicates} duplicates)"
+
+
+def _already_generated(engine, request, key):
+    # Mirrors the lookups BatchEngine.fetch_images makes before sending a request
+    if engine.force_regenerate:
+        return False
+    if engine.cache is not None and key in engine.cache:
+        return True
+    if engine.catalog is not None and is_seeded(request):
+        extension = os.path.splitext(engine.output_filename(request))[1]
+        return engine.catalog.find_request(key, extension) is not None
+    return False
+
+
+def estimate_sweep(plan, engine, credits_per_image=DEFAULT_CREDITS_PER_IMAGE,
+                   default_seconds=DEFAULT_REQUEST_SECONDS):
+    # Requests still to send, their cost in credits and the expected duration.
+    # Durations come from the catalog's recent timings per engine and are
+    # bounded by both the concurrency and the provider's rate limit.
+    per_engine = {}
+    for request in plan.requests:
+        engine_id = request["engine_id"]
+        stats = per_engine.setdefault(engine_id, {"requests": 0, "cached": 0, "credits": 0.0})
+        stats["requests"] += 1
+        if _already_generated(engine, request, engine.request_key(request, 0)):
+            stats["cached"] += 1
+            continue
+        stats["credits"] += credits_per_image * request["width"] * request["height"] / BASE_PIXELS
+
+    busy_seconds = 0.0
+    for engine_id, stats in per_engine.items():
+        seconds = None
+        if engine.catalog is not None:
+            seconds = engine.catalog.average_seconds(engine_id)
+        stats["seconds_per_request"] = seconds if seconds is not None else default_seconds
+        busy_seconds += (stats["requests"] - stats["cached"]) * stats["seconds_per_request"]
+
+    to_generate = sum(stats["requests"] - stats["cached"] for stats in per_engine.values())
+    rate_limit = engine.provider.capabilities.rate_limit
+    seconds = max(busy_seconds / engine.concurrency, to_generate / rate_limit if rate_limit else 0.0)
+    return {
+        "cells": len(plan.cells),
+        "requests": len(plan.requests),
+        "duplicates": plan.duplicates,
+        "cached": len(plan.requests) - to_generate,
+        "to_generate": to_generate,
+        "credits": sum(stats["credits"] for stats in per_engine.values()),
+        "seconds": seconds,
+        "engines": per_engine,
+    }
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes:02}m"
+    if minutes:
+        return f"{minutes}m {seconds:02}s"
+    return f"{seconds}s"
+
+
+def format_estimate(estimate, concurrency):
+    lines = []
+    for engine_id, stats in estimate["engines"].items():
+        lines.append(f"  {engine_id:<34} {stats['requests']:>6} requests  {stats['cached']:>6} already generated"
+                     f"  ~{stats['seconds_per_request']:.1f}s each")
+    lines.append(f"Estimate: {estimate['to_generate']} images to generate, ~{estimate['credits']:.1f} credits, "
+                 f"~{format_duration(estimate['seconds'])} at concurrency {concurrency}")
+    return "\n".join(lines)
+
+
+def run_sweep(engine, plan, on_result=None, on_status=None, should_stop=None, on_failure=None):
+    # Returns {request key: output path} for every request that produced an image
+    results = {}
+
+    def image_done(prompt, output_path):
+        results[engine.request_key(prompt, 0)] = output_path
+        if on_result is not None:
+            on_result(prompt, output_path)
+
+    engine.run(plan.requests, 1, on_result=image_done, on_status=on_status, should_stop=should_stop,
+               on_failure=on_failure)
+    return results
+
+
+def _seed_label(seed):
+    return "random seed" if seed is None else f"seed {seed}"
+
+
+def write_grid(plan, results, output_dir):
+    # index.html: per prompt, a table with a row per engine and style and a
+    # column per cfg scale and seed; sweep.json lists every cell and its image
+    manifest = []
+    sections = []
+    for index, prompt in enumerate(plan.prompts):
+        cells = [cell for cell in plan.cells if cell[0] == index]
+        rows = list(dict.fromkeys((engine_id, style) for _, engine_id, style, _, _, _ in cells))
+        columns = list(dict.fromkeys((cfg_scale, seed) for _, _, _, cfg_scale, seed, _ in cells))
+        images = {}
+        for _, engine_id, style, cfg_scale, seed, key in cells:
+            path = results.get(key)
+            images[(engine_id, style), (cfg_scale, seed)] = path
+            manifest.append({
+                "prompt": prompt["text"],
+                "engine_id": engine_id,
+                "style_preset": style,
+                "cfg_scale": cfg_scale,
+                "seed": seed,
+                "path": path,
+            })
+
+        header = "".join(f"<th>cfg {cfg_scale:g}<br>{_seed_label(seed)}</th>" for cfg_scale, seed in columns)
+        body = []
+        for row in rows:
+            tds = []
+            for column in columns:
+                path = images.get((row, column))
+                if path is None:
+                    tds.append('<td class="missing">not generated</td>')
+                    continue
+                src = html.escape(os.path.relpath(path, output_dir))
+                tds.append(f'<td><a href="{src}"><img src="{src}" width="{GRID_THUMBNAIL_SIZE}" '
+                           f'loading="lazy"></a></td>')
+            body.append(f"<tr><th>{html.escape(row[0])}<br>{html.escape(row[1])}</th>{''.join(tds)}</tr>")
+        sections.append(f"<h2>{html.escape(prompt['text'])}</h2>\n"
+                        f"<table>\n<tr><th></th>{header}</tr>\n" + "\n".join(body) + "\n</table>")
+
+    page = ("<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>Sweep</title><style>"
+            "table{border-collapse:collapse}th,td{border:1px solid #ccc;padding:4px;text-align:center}"
+            "td.missing{color:#999;width:" + str(GRID_THUMBNAIL_SIZE) + "px}</style></head><body>\n"
+            + "\n".join(sections) + "\n</body></html>\n")
+    grid_path = os.path.join(output_dir, GRID_FILE)
+    with open(grid_path, "w", encoding="utf-8") as f:
+        f.write(page)
+    with open(os.path.join(output_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    return grid_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep prompts over engines, styles, cfg scales and seeds")
+    parser.add_argument("prompt_file", help="text, CSV or JSONL prompt file (see batch_engine)")
+    parser.add_argument("--engines", default=DEFAULT_ENGINE_ID, help="comma-separated engine ids")
+    parser.add_argument("--styles", default=DEFAULT_STYLE_PRESET, help="comma-separated style presets")
+    parser.add_argument("--cfg-scale", help="cfg scales, e.g. 5,7,9 or 5:13:2 (default: 7 or the prompt's)")
+    parser.add_argument("--seeds", help="seeds, e.g. 1,2,3 or 1:8 (default: a random seed per request)")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--output-dir", default="sweep")
+    parser.add_argument("--no-cache", action="store_true", help="don't read or write the result cache")
+    parser.add_argument("--no-catalog", action="store_true", help="don't record images in the image catalog")
+    parser.add_argument("--force-regenerate", action="store_true", help="ignore cached results")
+    parser.add_argument("--credits-per-image", type=float, default=DEFAULT_CREDITS_PER_IMAGE,
+                        help="price of a 512x512 image for the cost estimate")
+    parser.add_argument("--dry-run", action="store_true", help="print the plan and estimate, then stop")
+    parser.add_argument("--api-key-file", default="api_key.txt")
+    parser.add_argument("--api-host", default=os.getenv("API_HOST", "https://api.stability.ai"))
+    parser.add_argument("--providers", help="JSON file of providers/API keys to spread the sweep over")
+    args = parser.parse_args(argv)
+
+    try:
+        engine_ids = parse_choices(args.engines, ENGINE_IDS, "engine")
+        style_presets = parse_choices(args.styles, STYLE_PRESETS, "style preset")
+        cfg_scales = parse_values(args.cfg_scale) if args.cfg_scale else []
+        seeds = parse_values(args.seeds, int) if args.seeds else []
+    except ValueError as e:
+        parser.error(str(e))
+    if not engine_ids or not style_presets:
+        parser.error("at least one engine and one style preset are needed")
+    if any(not 0 <= cfg_scale <= 35 for cfg_scale in cfg_scales):
+        parser.error("cfg scales must be within 0..35")
+    if any(not 0 <= seed <= MAX_SEED for seed in seeds):
+        parser.error(f"seeds must be within 0..{MAX_SEED}")
+
+    provider = None
+    api_key = None
+    if args.providers:
+        provider = load_providers(args.providers, client=get_client(args.concurrency))
+    elif not args.dry_run:
+        api_key = read_api_key(args.api_key_file)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    width, height = default_size(engine_ids[0])
+    engine = BatchEngine(
+        args.api_host, api_key, engine_ids[0], style_presets[0], 7, width, height, args.output_dir,
+        numbering=False,
+        concurrency=args.concurrency,
+        provider=provider,
+        cache=None if args.no_cache else ResultCache(),
+        force_regenerate=args.force_regenerate,
+        catalog=None if args.no_catalog else Catalog(),
+    )
+
+    prompt_list = read_prompt_list(args.prompt_file, width, height)
+    plan = SweepPlan(engine, prompt_list, engine_ids, style_presets, cfg_scales, seeds)
+    for line_no, message in prompt_list.errors:
+        print(f"  line {line_no}: {message}", file=sys.stderr)
+    print(f"Sweep: {plan.describe()}")
+    print(format_estimate(estimate_sweep(plan, engine, args.credits_per_image), engine.concurrency), flush=True)
+    if args.dry_run or not plan.requests:
+        return 0
+
+    done = 0
+    start = time.monotonic()
+
+    def on_result(prompt, output_path):
+        nonlocal done
+        done += 1
+        print(f"[{done}/{len(plan.requests)}] {output_path}", flush=True)
+
+    def on_failure(prompt, unit, message):
+        print(f"Failed '{prompt['text']}' on {prompt['engine_id']}/{prompt['style_preset']}: {message}",
+              file=sys.stderr, flush=True)
+
+    try:
+        results = run_sweep(engine, plan, on_result=on_result, on_failure=on_failure)
+    except KeyboardInterrupt:
+        print("Interrupted; cached images are reused when the sweep is run again", file=sys.stderr)
+        return 130
+    finally:
+        if engine.catalog is not None:
+            engine.catalog.flush()
+
+    grid_path = write_grid(plan, results, args.output_dir)
+    print(f"Done: {done}/{len(plan.requests)} images, {engine.failed} failed "
+          f"in {format_duration(time.monotonic() - start)}; grid: {grid_path}")
+    print(metrics.status_text())
+    return 1 if engine.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
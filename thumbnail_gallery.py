@@ -0,0 +1,161 @@
+# Virtualized thumbnail gallery for long batch runs
+# The model only stores file paths; thumbnails are decoded on demand for the
+# rows the view actually paints and kept in a size-bounded LRU cache, so
+# memory and repaint cost stay flat however many images a batch produces.
+# Past a row limit the oldest rows are dropped; the images stay on disk and
+# in the catalog.
+
+import os
+from collections import OrderedDict
+
+from qtpy import QtCore, QtGui, QtWidgets
+
+from metrics import metrics
+
+THUMBNAIL_SIZE = 160
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_ITEMS = 5000
+
+
+class ThumbnailCache:
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, size=THUMBNAIL_SIZE):
+        self.max_bytes = max_bytes
+        self.size = size
+        self.total_bytes = 0
+
+        # path -> QPixmap, least recently used first
+        self._pixmaps = OrderedDict()
+
+    @staticmethod
+    def _cost(pixmap):
+        return pixmap.width() * pixmap.height() * max(1, pixmap.depth() // 8)
+
+    def get(self, path):
+        pixmap = self._pixmaps.get(path)
+        if pixmap is not None:
+            self._pixmaps.move_to_end(path)
+            return pixmap
+
+        with metrics.span("preview"):
+            pixmap = self.load(path)
+        self._pixmaps[path] = pixmap
+        self.total_bytes += self._cost(pixmap)
+        while self.total_bytes > self.max_bytes and len(self._pixmaps) > 1:
+            _, evicted = self._pixmaps.popitem(last=False)
+            self.total_bytes -= self._cost(evicted)
+        return pixmap
+
+    def load(self, path):
+        # Let the image reader scale while decoding rather than building a
+        # full-resolution pixmap first
+        reader = QtGui.QImageReader(path)
+        reader.setAutoTransform(True)
+        size = reader.size()
+        if size.isValid():
+            reader.setScaledSize(size.scaled(self.size, self.size, QtCore.Qt.KeepAspectRatio))
+        image = reader.read()
+        if image.isNull():
+            pixmap = QtGui.QPixmap(self.size, self.size)
+            pixmap.fill(QtCore.Qt.darkGray)
+            return pixmap
+        return QtGui.QPixmap.fromImage(image)
+
+    def clear(self):
+        self._pixmaps.clear()
+        self.total_bytes = 0
+
+
+class GalleryModel(QtCore.QAbstractListModel):
+    PathRole = QtCore.Qt.UserRole + 1
+
+    def __init__(self, thumbnail_cache, parent=None, max_items=DEFAULT_MAX_ITEMS):
+        super().__init__(parent)
+        self.thumbnail_cache = thumbnail_cache
+        self.max_items = max_items
+        self._items = []
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._items)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        path, prompt_text = self._items[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            return os.path.basename(path)
+        if role == QtCore.Qt.ToolTipRole:
+            return prompt_text
+        if role == QtCore.Qt.DecorationRole:
+            return self.thumbnail_cache.get(path)
+        if role == self.PathRole:
+            return path
+        return None
+
+    def add_image(self, path, prompt_text):
+        row = len(self._items)
+        self.beginInsertRows(QtCore.QModelIndex(), row, row)
+        self._items.append((path, prompt_text))
+        self.endInsertRows()
+        if self.max_items and len(self._items) > self.max_items:
+            # Drop the oldest rows in chunks so the view rarely has to shift
+            excess = len(self._items) - self.max_items + self.max_items // 10
+            self.beginRemoveRows(QtCore.QModelIndex(), 0, excess - 1)
+            del self._items[:excess]
+            self.endRemoveRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self._items = []
+        self.thumbnail_cache.clear()
+        self.endResetModel()
+
+
+class ThumbnailGallery(QtWidgets.QListView):
+    def __init__(self, parent=None, cache_bytes=DEFAULT_CACHE_BYTES, max_items=DEFAULT_MAX_ITEMS):
+        super().__init__(parent)
+        self.gallery_model = GalleryModel(ThumbnailCache(cache_bytes), self, max_items)
+        self.setModel(self.gallery_model)
+
+        self.setViewMode(QtWidgets.QListView.IconMode)
+        self.setResizeMode(QtWidgets.QListView.Adjust)
+        self.setMovement(QtWidgets.QListView.Static)
+        self.setIconSize(QtCore.QSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        self.setGridSize(QtCore.QSize(THUMBNAIL_SIZE + 20, THUMBNAIL_SIZE + 40))
+        self.setUniformItemSizes(True)
+        self.setWordWrap(True)
+        self.setSelectionMode(QtWidgets.QAbstractItemView.SingleSelection)
+
+        # Lay out new rows in batches instead of reflowing everything per insert
+        self.setLayoutMode(QtWidgets.QListView.Batched)
+        self.setBatchSize(100)
+
+        self.doubleClicked.connect(self.open_full_image)
+
+    def add_image(self, path, prompt_text):
+        # Follow new images only while the user is already looking at the end
+        scroll_bar = self.verticalScrollBar()
+        at_bottom = scroll_bar.value() >= scroll_bar.maximum() - 4
+        with metrics.span("layout"):
+            self.gallery_model.add_image(path, prompt_text)
+            if at_bottom:
+                self.scrollToBottom()
+
+    def clear(self):
+        self.gallery_model.clear()
+
+    def open_full_image(self, index):
+        # Full-resolution images are only ever read from disk on request
+        path = index.data(GalleryModel.PathRole)
+        dialog = QtWidgets.QDialog(self)
+        dialog.setWindowTitle(os.path.basename(path))
+        dialog.setAttribute(QtCore.Qt.WA_DeleteOnClose)
+        image_label = QtWidgets.QLabel()
+        image_label.setPixmap(QtGui.QPixmap(path))
+        scroll_area = QtWidgets.QScrollArea()
+        scroll_area.setWidget(image_label)
+        layout = QtWidgets.QVBoxLayout(dialog)
+        layout.addWidget(scroll_area)
+        dialog.resize(800, 800)
+        dialog.show()